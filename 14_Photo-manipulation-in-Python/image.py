@@ -10,6 +10,8 @@ Github: https://www.github.com/kying18
 Programmer Beast Mode Spotify playlist: https://open.spotify.com/playlist/4Akns5EUb3gzmlXIdsJkPs?si=qGc4ubKRRYmPHAJAIrCxVQ 
 """
 
+import os
+
 import numpy as np
 import png
 
@@ -34,11 +36,9 @@ class Image:
         read PNG RGB image, return 3D numpy array organized along Y, X, channel
         values are float, gamma is decoded
         '''
-        im = png.Reader(self.input_path + filename).asFloat()
-        resized_image = np.vstack(list(im[2]))
-        resized_image.resize(im[1], im[0], 3)
-        resized_image = resized_image ** gamma
-        return resized_image
+        decode = lambda v: v**gamma
+        return png.Reader(self.input_path + filename).asarray(
+            np.float64, transfer=decode)[2]
 
     def write_image(self, output_file_name, gamma=2.2):
         '''
@@ -47,7 +47,7 @@ class Image:
         im = np.clip(self.array, 0, 1)
         y, x = self.array.shape[0], self.array.shape[1]
         im = im.reshape(y, x*3)
-        writer = png.Writer(x, y)
+        writer = png.Writer(x, y, compression='auto', workers=os.cpu_count())
         with open(self.output_path + output_file_name, 'wb') as f:
             writer.write(f, 255*(im**(1/gamma)))
 
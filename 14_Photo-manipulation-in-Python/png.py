@@ -121,32 +121,56 @@ And now, my famous members
 
 __version__ = "0.0.18"
 
+import contextlib
+import hashlib
+import io
 import itertools
 import math
+import mmap
 import re
 # http://www.python.org/doc/2.4.4/lib/module-operator.html
 import operator
+import os
+import queue
+import random
 import struct
 import sys
+import threading
+import time
 # http://www.python.org/doc/2.4.4/lib/module-warnings.html
 import warnings
 import zlib
 
 from array import array
-from functools import reduce
+from collections import OrderedDict, deque
 
 try:
     # `cpngfilters` is a Cython module: it must be compiled by
     # Cython for this import to work.
-    # If this import does work, then it overrides pure-python
-    # filtering functions defined later in this file (see `class
-    # pngfilters`).
-    import cpngfilters as pngfilters
+    # If this import does work, then it is registered as a filter
+    # backend and is preferred over the filtering functions defined
+    # later in this file (see `class pngfilters` and
+    # :func:`use_filter_backend`).
+    import cpngfilters
 except ImportError:
-    pass
+    cpngfilters = None
+
+try:
+    # NumPy is optional.  When it is available whole blocks of
+    # scanlines are unfiltered at once (see `class npfilters`).
+    import numpy
+except ImportError:
+    numpy = None
 
 
-__all__ = ['Image', 'Reader', 'Writer', 'write_chunks', 'from_array']
+__all__ = ['Image', 'Reader', 'Writer', 'StripWriter', 'Encoder',
+           'write_chunks', 'from_array',
+           'probe', 'decode_many', 'encode_many', 'AsyncReader',
+           'AsyncWriter', 'Stats', 'instrument', 'ImageCache', 'use_cache',
+           'cache_info',
+           'filter_backend', 'use_filter_backend', 'filter_backend_info',
+           'register_filter_backend', 'check_filter_backends',
+           'benchmark_filter_backend']
 
 
 # The PNG signature.
@@ -161,6 +185,32 @@ _adam7 = ((0, 0, 8, 8),
           (1, 0, 2, 2),
           (0, 1, 1, 2))
 
+# The pixels of an interlaced image that are known after each Adam7
+# pass form a grid; this is its spacing (*xstep*, *ystep*).
+_adam7_grid = ((8, 8), (4, 8), (4, 4), (2, 4), (2, 2), (1, 2), (1, 1))
+
+# Named values for the `compression` argument of :class:`Writer`: the
+# ``zlib`` level, strategy, memory level and window size, and the
+# filter type used when `filter_type` is not given.  A strategy or
+# filter type of ``None`` means it is picked by trial compression.
+_compression_profiles = {
+  'fast': dict(level=1, strategy=zlib.Z_RLE, memlevel=9, wbits=15,
+               filter_type=1),
+  'balanced': dict(level=6, strategy=zlib.Z_FILTERED, memlevel=8,
+                   wbits=15, filter_type='adaptive'),
+  'smallest': dict(level=9, strategy=None, memlevel=9, wbits=15,
+                   filter_type=None),
+  'auto': dict(level=6, strategy=None, memlevel=8, wbits=15,
+               filter_type=None),
+}
+
+# The strategies tried by the ``'auto'`` profile, fastest first (the
+# first of those that compress the sample equally well is used), and
+# the size of the sample.
+_auto_strategies = (zlib.Z_HUFFMAN_ONLY, zlib.Z_RLE, zlib.Z_FILTERED,
+                    zlib.Z_DEFAULT_STRATEGY)
+_auto_sample_size = 2**18
+
 def group(s, n):
     # See http://www.python.org/doc/2.6/library/functions.html#zip
     return list(zip(*[iter(s)]*n))
@@ -168,9 +218,185 @@ def group(s, n):
 def isarray(x):
     return isinstance(x, array)
 
+def isbuffer(x):
+    try:
+        memoryview(x)
+    except TypeError:
+        return False
+    return True
+
 def tostring(row):
     return row.tobytes()
 
+# Tables for unpacking samples of bit depth 1, 2, and 4, keyed by bit
+# depth.  See :func:`unpack_table`.
+_unpack_tables = {}
+
+def unpack_table(bitdepth):
+    """Return the table for unpacking samples of bit depth `bitdepth`
+    (1, 2, or 4).  Entry *n* of the table is a byte string of the
+    samples packed (most significant first) into the byte *n*.  When
+    NumPy is available a second table, a (256, *samples per byte*)
+    uint8 array, is built alongside; see :func:`unpack_samples`.
+    """
+
+    table = _unpack_tables.get(bitdepth)
+    if table is None:
+        # Samples per byte
+        spb = 8 // bitdepth
+        mask = 2**bitdepth - 1
+        shifts = [bitdepth * i for i in reversed(range(spb))]
+        table = [bytes(bytearray((o >> i) & mask for i in shifts))
+                 for o in range(256)]
+        _unpack_tables[bitdepth] = table
+        if numpy is not None:
+            _unpack_tables[bitdepth, 'numpy'] = numpy.frombuffer(
+              b''.join(table), dtype=numpy.uint8).reshape(256, spb)
+    return table
+
+def sample_array(row, bitdepth):
+    """Convert `row`, a NumPy array or another object supporting the
+    buffer protocol (such as ``bytes``, ``memoryview`` or ``array``),
+    to a flat, C-contiguous NumPy array of ``uint8`` or ``uint16``
+    samples for a PNG of bit depth `bitdepth`.  Floating point
+    samples are truncated to integers, as ``int`` does.  Raises
+    ``ValueError`` if a sample is outside the range of the bit depth.
+    Requires NumPy.
+    """
+
+    if not isinstance(row, numpy.ndarray):
+        row = numpy.asarray(memoryview(row))
+    row = row.reshape(-1)
+    maxval = 2**bitdepth - 1
+    dtype = (numpy.uint8, numpy.uint16)[bitdepth > 8]
+    if row.dtype.kind == 'f':
+        row = numpy.trunc(row)
+    elif row.dtype.kind not in 'uib':
+        raise ValueError("cannot write samples of type %s" % row.dtype)
+    if row.dtype != dtype or maxval != numpy.iinfo(dtype).max:
+        # Written so that NaN fails the test.
+        if len(row) and not (row.min() >= 0 and row.max() <= maxval):
+            raise ValueError(
+              "sample values outside range for bit depth %d" % bitdepth)
+    return numpy.ascontiguousarray(row, dtype=dtype)
+
+# Tables for packing samples of bit depth 1, 2, and 4, keyed by bit
+# depth.  Maps a tuple of samples to the byte they pack into.
+_pack_tables = {}
+
+def pack_samples(row, bitdepth):
+    """Pack a row of samples of bit depth `bitdepth` (1, 2, or 4) into
+    bytes, most significant sample first, padding the last byte with
+    zero bits.  Returns a byte string.  With NumPy, `row` can also be
+    a 2-dimensional array of rows, each of which is packed (and padded)
+    separately.
+    """
+
+    spb = 8 // bitdepth
+    if numpy is not None:
+        a = numpy.asarray(row)
+        if a.size and a.max() > 2**bitdepth - 1:
+            raise ValueError(
+              "sample value too big for bit depth %d" % bitdepth)
+        a = a.astype(numpy.uint8).reshape(-1, a.shape[-1])
+        if bitdepth == 1:
+            return numpy.packbits(a, axis=1).tobytes()
+        extra = -a.shape[1] % spb
+        if extra:
+            a = numpy.pad(a, ((0, 0), (0, extra)), 'constant')
+        a = a.reshape(len(a), -1, spb)
+        shifts = numpy.arange(8 - bitdepth, -1, -bitdepth,
+                              dtype=numpy.uint8)
+        return numpy.bitwise_or.reduce(a << shifts, axis=2).tobytes()
+    table = _pack_tables.get(bitdepth)
+    if table is None:
+        # Inverse of the unpacking table.
+        table = dict((tuple(bytearray(samples)), n)
+                     for n, samples in enumerate(unpack_table(bitdepth)))
+        _pack_tables[bitdepth] = table
+    a = array('B', row)
+    # Pad so that the row is a whole number of bytes.
+    a.extend([0] * (-len(a) % spb))
+    try:
+        return bytes(bytearray(map(table.__getitem__, group(a, spb))))
+    except KeyError:
+        raise ValueError(
+          "sample value too big for bit depth %d" % bitdepth)
+
+def float_table(bitdepth, maxval=1.0, transfer=None):
+    """Return a lookup table (a list) that maps each sample value of
+    bit depth `bitdepth` to a float between 0.0 and `maxval`.  If
+    `transfer` is given, it is a function that is applied to those
+    scaled values, for example ``lambda v: v**2.2`` to decode gamma.
+    It is called once with all the values as a NumPy array when NumPy
+    is available, and with each value in turn otherwise, so it should
+    be written with arithmetic operators or NumPy ufuncs.
+    """
+
+    factor = float(maxval)/float(2**bitdepth - 1)
+    table = [factor * v for v in range(2**bitdepth)]
+    if transfer is not None:
+        if numpy is not None:
+            table = numpy.asarray(transfer(numpy.array(table)),
+                                  dtype=numpy.float64).tolist()
+        else:
+            table = [float(transfer(v)) for v in table]
+    return table
+
+def unpack16(raw):
+    """Convert `raw`, a sequence of bytes holding big-endian 16-bit
+    samples (as stored in a PNG file), to an ``array('H')``.  The bytes
+    are copied and swapped in bulk; no Python object is made per
+    sample.
+    """
+
+    a = array('H')
+    a.frombytes(raw)
+    if sys.byteorder == 'little':
+        a.byteswap()
+    return a
+
+def pack16(row):
+    """Convert a row of 16-bit samples to a byte string of big-endian
+    samples (as stored in a PNG file).  `row` can be any sequence of
+    ints; an ``array('H')`` or a NumPy array is converted without
+    making a Python object per sample.
+    """
+
+    if numpy is not None and isinstance(row, numpy.ndarray):
+        return row.astype('>u2').tobytes()
+    a = array('H', row)
+    if sys.byteorder == 'little':
+        a.byteswap()
+    return a.tobytes()
+
+def unpack_samples(packed, bitdepth, width):
+    """Unpack the samples of bit depth `bitdepth` (1, 2, or 4) from
+    `packed`, a sequence of bytes holding one or more rows of `width`
+    samples each, each row starting on a byte boundary.  Returns the
+    samples as a byte string, without the padding bits at the end of
+    each row.
+    """
+
+    unpack_table(bitdepth)
+    spb = 8 // bitdepth
+    row_bytes = (width + spb - 1) // spb
+    if numpy is not None:
+        a = numpy.frombuffer(packed, dtype=numpy.uint8)
+        a = a.reshape(-1, row_bytes)
+        if bitdepth == 1:
+            out = numpy.unpackbits(a, axis=1)
+        else:
+            out = _unpack_tables[bitdepth, 'numpy'][a].reshape(len(a), -1)
+        return out[:, :width].tobytes()
+    table = _unpack_tables[bitdepth]
+    packed = bytes(packed)
+    if width == row_bytes * spb:
+        return b''.join(map(table.__getitem__, packed))
+    return b''.join(b''.join(map(table.__getitem__,
+                                 packed[i:i+row_bytes]))[:width]
+      for i in range(0, len(packed), row_bytes))
+
 def interleave_planes(ipixels, apixels, ipsize, apsize):
     """
     Interleave (colour) planes, e.g. RGB + A = RGBA.
@@ -314,7 +540,10 @@ class Writer:
                  chunk_limit=2**20,
                  x_pixels_per_unit = None,
                  y_pixels_per_unit = None,
-                 unit_is_meter = False):
+                 unit_is_meter = False,
+                 filter_type=None,
+                 workers=None,
+                 sync_rows=None):
         """
         Create a PNG encoder object.
         Arguments:
@@ -337,8 +566,9 @@ class Writer:
         gamma
           Specify a gamma value (create a ``gAMA`` chunk).
         compression
-          zlib compression level: 0 (none) to 9 (more compressed);
-          default: -1 or None.
+          zlib compression level: 0 (none) to 9 (more compressed),
+          or a profile: ``'fast'``, ``'balanced'``, ``'smallest'``, or
+          ``'auto'``; default: -1 or None.
         interlace
           Create an interlaced image.
         chunk_limit
@@ -353,6 +583,15 @@ class Writer:
         unit_is_meter
           `True` to indicate that the unit (for the `pHYs`
           chunk) is metre.
+        filter_type
+          Scanline filter: 0 (none) to 4 (Paeth), or ``'adaptive'``;
+          default: 0, or as chosen by the `compression` profile.
+        workers
+          Number of threads used to compress the image data;
+          default: ``None`` (compress in the calling thread).
+        sync_rows
+          Make the image data seekable every `sync_rows` rows (write
+          a private ``syNC`` chunk).
         The image size (in pixels) can be specified either by using the
         `width` and `height` arguments, or with the single `size`
         argument.  If `size` is used it should be a pair (*width*,
@@ -415,6 +654,26 @@ class Writer:
         no compression.  -1 and ``None`` both mean that the default
         level of compession will be picked by the ``zlib`` module
         (which is generally acceptable).
+        Instead of a level, `compression` can name a profile, which
+        chooses the ``zlib`` level, strategy, memory level and window
+        size, and the filter type (unless `filter_type` is given):
+        ``'fast'`` (level 1, run length encoding only, and filter
+        type 1) is for when encoding time matters most; ``'balanced'``
+        (level 6, ``Z_FILTERED``, adaptive filtering) usually makes
+        photographic images considerably smaller than the default.
+        ``'auto'`` is like ``'balanced'``, except that the strategy is
+        picked by trial compressing the start of the image data with
+        each of ``Z_HUFFMAN_ONLY``, ``Z_RLE``, ``Z_FILTERED``, and
+        ``Z_DEFAULT_STRATEGY``; the fastest of those that give the
+        smallest result is used.  The start of the image data is tried
+        both unfiltered and with adaptive filtering, and the better of
+        the two is used for the whole image (some images, such as
+        those with few colours, compress much better unfiltered).
+        ``'smallest'`` is like ``'auto'`` but at level 9, and is the
+        slowest.  With these two profiles, interlaced images and
+        images written with `sync_rows` are always filtered
+        adaptively.  Profiles do not filter colour
+        mapped images or images with bit depths below 8.
         If `interlace` is true then an interlaced image is created
         (using PNG's so far only interace method, *Adam7*).  This does
         not affect how the pixels should be presented to the encoder,
@@ -428,6 +687,32 @@ class Writer:
         `chunk_limit` is used to limit the amount of memory used whilst
         compressing the image.  In order to avoid using large amounts of
         memory, multiple ``IDAT`` chunks may be created.
+        `filter_type` selects the filter that is applied to each
+        scanline before compression (see
+        http://www.w3.org/TR/PNG/#9Filters ).  A number from 0 to 4
+        uses that filter type for every scanline.  ``'adaptive'``
+        picks a filter for each scanline separately, using the
+        minimum sum of absolute differences heuristic recommended by
+        the PNG specification; this usually makes photographic images
+        considerably smaller, at some cost in encoding time (colour
+        mapped images and bit depths below 8 are not filtered).
+        When `workers` is more than 1 the (filtered) image data is
+        split into blocks that are compressed independently by a pool
+        of that many threads, in the style of ``pigz``.  The blocks are
+        joined at full flush points into a single valid ``zlib``
+        stream, so the file is slightly larger than when compressing
+        in one thread, but large images are compressed several times
+        faster on a multi-core machine.  The pool is made when it is
+        first needed and used for every image the writer writes, until
+        :meth:`close` is called.
+        If `sync_rows` is specified then a ``zlib`` full flush point
+        is made at the start of every `sync_rows`-th row, and the rows
+        at those points are filtered without reference to the previous
+        row (using filter type 0 or 1).  A ``syNC`` chunk (a private
+        ancillary chunk; other decoders ignore it) records where they
+        are, so that :meth:`Reader.read_rows` can decode a range of
+        rows without decompressing the rows above it.  Not compatible
+        with `interlace`.
         """
 
         # At the moment the `planes` argument is ignored;
@@ -503,6 +788,31 @@ class Writer:
         if bitdepth > 8 and palette:
             raise ValueError(
                 "bit depth must be 8 or less for images with palette")
+        if sync_rows is not None and interlace:
+            raise ValueError("sync_rows and interlace not compatible")
+        if sync_rows is not None and (not isinteger(sync_rows) or
+                                      sync_rows < 1):
+            raise ValueError("sync_rows (%r) must be a positive integer" %
+                             (sync_rows,))
+        profile = {}
+        if isinstance(compression, str):
+            if compression not in _compression_profiles:
+                raise ValueError(
+                  "compression (%r) must be a level or one of %s" %
+                  (compression, ', '.join(sorted(_compression_profiles))))
+            profile = _compression_profiles[compression]
+        trial_filter = False
+        if filter_type is None:
+            filter_type = 0
+            if profile and not palette and bitdepth >= 8:
+                filter_type = profile['filter_type']
+                if filter_type is None:
+                    filter_type = 'adaptive'
+                    trial_filter = True
+        if filter_type not in (0, 1, 2, 3, 4, 'adaptive'):
+            raise ValueError(
+                "filter_type (%r) must be 0 to 4 or 'adaptive'" %
+                (filter_type,))
 
         transparent = check_color(transparent, greyscale, 'transparent')
         background = check_color(background, greyscale, 'background')
@@ -526,6 +836,14 @@ class Writer:
         self.x_pixels_per_unit = x_pixels_per_unit
         self.y_pixels_per_unit = y_pixels_per_unit
         self.unit_is_meter = bool(unit_is_meter)
+        self.filter_type = filter_type
+        # Whether to try leaving the image unfiltered (see
+        # :meth:`choose_filter`).
+        self.trial_filter = trial_filter
+        self.workers = workers
+        # The pool of threads for `workers`, see :meth:`make_compressor`.
+        self.pool = None
+        self.sync_rows = sync_rows
 
         self.color_type = 4*self.alpha + 2*(not greyscale) + 1*self.colormap
         assert self.color_type in (0,2,3,4,6)
@@ -535,6 +853,22 @@ class Writer:
         # :todo: fix for bitdepth < 8
         self.psize = (self.bitdepth/8) * self.planes
 
+    def close(self):
+        """Shut down the pool of threads that compresses the image
+        data when `workers` is more than 1, if it has been made.
+        Writing another image afterwards makes a new pool.
+        """
+
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
     def make_palette(self):
         """Create the byte sequences for a ``PLTE`` and if necessary a
         ``tRNS`` chunk.  Returned as a pair (*p*, *t*).  *t* will be
@@ -570,7 +904,13 @@ class Writer:
 
         if self.interlace:
             fmt = 'BH'[self.bitdepth > 8]
-            a = array(fmt, itertools.chain(*rows))
+            a = array(fmt)
+            for row in rows:
+                if numpy is not None and isbuffer(row):
+                    row = sample_array(row, self.source_bitdepth())
+                    a.frombytes(row.astype(fmt).tobytes())
+                else:
+                    a.extend(row)
             return self.write_array(outfile, a)
 
         nrows = self.write_passes(outfile, rows)
@@ -579,21 +919,10 @@ class Writer:
               "rows supplied (%d) does not match height (%d)" %
               (nrows, self.height))
 
-    def write_passes(self, outfile, rows, packed=False):
-        """
-        Write a PNG image to the output file.
-        Most users are expected to find the :meth:`write` or
-        :meth:`write_array` method more convenient.
-        
-        The rows should be given to this method in the order that
-        they appear in the output file.  For straightlaced images,
-        this is the usual top to bottom ordering, but for interlaced
-        images the rows should have already been interlaced before
-        passing them to this function.
-        `rows` should be an iterable that yields each row.  When
-        `packed` is ``False`` the rows should be in boxed row flat pixel
-        format; when `packed` is ``True`` each row should be a packed
-        sequence of bytes.
+    def write_preamble(self, outfile):
+        """Write the PNG signature and the chunks that come before the
+        image data (``IHDR``, and ``gAMA``, ``sBIT``, ``PLTE``,
+        ``tRNS``, ``bKGD``, and ``pHYs`` as needed) to `outfile`.
         """
 
         # http://www.w3.org/TR/PNG/#5PNG-file-signature
@@ -653,102 +982,346 @@ class Writer:
             tup = (self.x_pixels_per_unit, self.y_pixels_per_unit, int(self.unit_is_meter))
             write_chunk(outfile, b'pHYs', struct.pack("!LLB",*tup))
 
+    def write_passes(self, outfile, rows, packed=False):
+        """
+        Write a PNG image to the output file.
+        Most users are expected to find the :meth:`write` or
+        :meth:`write_array` method more convenient.
+        
+        The rows should be given to this method in the order that
+        they appear in the output file.  For straightlaced images,
+        this is the usual top to bottom ordering, but for interlaced
+        images the rows should have already been interlaced before
+        passing them to this function.
+        `rows` should be an iterable that yields each row.  When
+        `packed` is ``False`` the rows should be in boxed row flat pixel
+        format; when `packed` is ``True`` each row should be a packed
+        sequence of bytes.
+        When NumPy is available a row can also be a NumPy array or
+        other buffer (see :func:`sample_array`), which is converted as
+        a whole.
+        """
+
+        self.write_preamble(outfile)
+
         # http://www.w3.org/TR/PNG/#11IDAT
-        if self.compression is not None:
-            compressor = zlib.compressobj(self.compression)
-        else:
-            compressor = zlib.compressobj()
-
-        # Choose an extend function based on the bitdepth.  The extend
-        # function packs/decomposes the pixel values into bytes and
-        # stuffs them onto the data array.
-        data = array('B')
-        if self.bitdepth == 8 or packed:
-            extend = data.extend
-        elif self.bitdepth == 16:
-            # Decompose into bytes
-            def extend(sl):
-                fmt = '!%dH' % len(sl)
-                data.extend(array('B', struct.pack(fmt, *sl)))
-        else:
-            # Pack into bytes
-            assert self.bitdepth < 8
-            # samples per byte
-            spb = int(8/self.bitdepth)
-            def extend(sl):
-                a = array('B', sl)
-                # Adding padding bytes so we can group into a whole
-                # number of spb-tuples.
-                l = float(len(a))
-                extra = math.ceil(l / float(spb))*spb - l
-                a.extend([0]*int(extra))
-                # Pack into bytes
-                l = group(a, spb)
-                l = [reduce(lambda x,y:
-                                           (x << self.bitdepth) + y, e) for e in l]
-                data.extend(l)
-        if self.rescale:
-            oldextend = extend
-            factor = \
-              float(2**self.rescale[1]-1) / float(2**self.rescale[0]-1)
-            def extend(sl):
-                oldextend([int(round(factor*x)) for x in sl])
-
-        # Build the first row, testing mostly to see if we need to
-        # changed the extend function to cope with NumPy integer types
-        # (they cause our ordinary definition of extend to fail, so we
-        # wrap it).  See
-        # http://code.google.com/p/pypng/issues/detail?id=44
-        enumrows = enumerate(rows)
-        del rows
-
-        # First row's filter type.
-        data.append(0)
-        # :todo: Certain exceptions in the call to ``.next()`` or the
-        # following try would indicate no row data supplied.
-        # Should catch.
-        i,row = next(enumrows)
+        # The compressor is made when there is some data, so that it
+        # can be used as a sample (see :meth:`make_compressor`).
+        compressor = [None]
         try:
-            # If this fails...
-            extend(row)
-        except:
-            # ... try a version that converts the values to int first.
-            # Not only does this work for the (slightly broken) NumPy
-            # types, there are probably lots of other, unknown, "nearly"
-            # int types it works for.
-            def wrapmapint(f):
-                return lambda sl: f([int(x) for x in sl])
-            extend = wrapmapint(extend)
-            del wrapmapint
-            extend(row)
-
-        for i,row in enumrows:
-            # Add "None" filter type.  Currently, it's essential that
-            # this filter type be used for every scanline as we do not
-            # mark the first row of a reduced pass image; that means we
-            # could accidentally compute the wrong filtered scanline if
-            # we used "up", "average", or "paeth" on such a line.
+            def compress(data):
+                start = _start()
+                if compressor[0] is None:
+                    compressor[0] = self.make_compressor(data)
+                compressed = compressor[0].compress(data)
+                _record('deflate', start, len(data))
+                return compressed
+            def flush(*mode):
+                start = _start()
+                if compressor[0] is None:
+                    compressor[0] = self.make_compressor()
+                flushed = compressor[0].flush(*mode)
+                _record('deflate', start)
+                return flushed
+            # Size of the IDAT data written so far, and the sync points
+            # (row, offset into the IDAT data) for the ``syNC`` chunk.
+            idat_size = 0
+            syncs = []
+
+            # Choose an extend function based on the bitdepth.  The extend
+            # function packs/decomposes the pixel values into bytes and
+            # stuffs them onto the data array.
+            data = array('B')
+            if self.bitdepth == 8 or packed:
+                def extend(sl):
+                    if isbuffer(sl) and memoryview(sl).itemsize == 1:
+                        data.frombytes(sl)
+                    else:
+                        data.extend(sl)
+            elif self.bitdepth == 16:
+                # Decompose into bytes
+                def extend(sl):
+                    data.frombytes(pack16(sl))
+            else:
+                # Pack into bytes
+                assert self.bitdepth < 8
+                def extend(sl):
+                    data.frombytes(pack_samples(sl, self.bitdepth))
+            if self.rescale:
+                oldextend = extend
+                factor = \
+                  float(2**self.rescale[1]-1) / float(2**self.rescale[0]-1)
+                dtype = None
+                if numpy is not None:
+                    dtype = (numpy.uint8, numpy.uint16)[self.bitdepth > 8]
+                def extend(sl):
+                    if dtype and isinstance(sl, numpy.ndarray):
+                        oldextend(numpy.rint(factor*sl).astype(dtype))
+                    else:
+                        oldextend([int(round(factor*x)) for x in sl])
+            if numpy is not None and not packed:
+                # Convert buffers (including NumPy arrays) as a whole.
+                bitdepth = self.source_bitdepth()
+                bufferextend = extend
+                def extend(sl):
+                    if isbuffer(sl):
+                        sl = sample_array(sl, bitdepth)
+                    bufferextend(sl)
+
+            filter_row = self.make_filter_row(data)
+            # With the ``'auto'`` profile the first rows are left
+            # unfiltered, until :meth:`choose_filter` has tried both ways.
+            trial_rows = 0
+            if (self.trial_filter and filter_row and not packed and
+              not self.interlace and not self.sync_rows):
+                row_bytes = int(math.ceil(self.width * self.psize)) + 1
+                trial_rows = max(1, min(_auto_sample_size, self.chunk_limit)
+                                    // row_bytes)
+                filter_row = None
+
+            # Build the first row, testing mostly to see if we need to
+            # changed the extend function to cope with NumPy integer types
+            # (they cause our ordinary definition of extend to fail, so we
+            # wrap it).  See
+            # http://code.google.com/p/pypng/issues/detail?id=44
+            enumrows = enumerate(rows)
+            del rows
+
+            # First row's filter type.
             data.append(0)
-            extend(row)
-            if len(data) > self.chunk_limit:
-                compressed = compressor.compress(tostring(data))
-                if len(compressed):
+            # :todo: Certain exceptions in the call to ``.next()`` or the
+            # following try would indicate no row data supplied.
+            # Should catch.
+            i,row = next(enumrows)
+            try:
+                # If this fails...
+                extend(row)
+            except:
+                if numpy is not None and isbuffer(row):
+                    # Converted by :func:`sample_array`, which has
+                    # already done its best.
+                    raise
+                # ... try a version that converts the values to int first.
+                # Not only does this work for the (slightly broken) NumPy
+                # types, there are probably lots of other, unknown, "nearly"
+                # int types it works for.
+                def wrapmapint(f):
+                    return lambda sl: f([int(x) for x in sl])
+                extend = wrapmapint(extend)
+                del wrapmapint
+                extend(row)
+            if filter_row:
+                filter_row(1, 0)
+
+            for i,row in enumrows:
+                if i == trial_rows:
+                    filter_row, strategy = self.choose_filter(data, i,
+                                                              row_bytes)
+                    _close_compressor(compressor[0])
+                    compressor[0] = self.make_compressor(strategy=strategy)
+                if self.sync_rows and i % self.sync_rows == 0:
+                    # Compress everything so far, and end it at a full
+                    # flush point, where decompression can start afresh.
+                    compressed = compress(tostring(data))
+                    compressed += flush(zlib.Z_FULL_FLUSH)
+                    del data[:]
                     write_chunk(outfile, b'IDAT', compressed)
-                # Because of our very witty definition of ``extend``,
-                # above, we must re-use the same ``data`` object.  Hence
-                # we use ``del`` to empty this one, rather than create a
-                # fresh one (which would be my natural FP instinct).
-                del data[:]
-        if len(data):
-            compressed = compressor.compress(tostring(data))
-        else:
-            compressed = b''
-        flushed = compressor.flush()
-        if len(compressed) or len(flushed):
-            write_chunk(outfile, b'IDAT', compressed + flushed)
-        # http://www.w3.org/TR/PNG/#11IEND
-        write_chunk(outfile, b'IEND')
-        return i+1
+                    idat_size += len(compressed)
+                    syncs.append((i, idat_size))
+                # Add "None" filter type.  When a different filter is
+                # used, `filter_row` replaces the type byte and the
+                # scanline just added to `data`.
+                data.append(0)
+                start = len(data)
+                extend(row)
+                if filter_row:
+                    filter_row(start, i)
+                if len(data) > self.chunk_limit:
+                    compressed = compress(tostring(data))
+                    if len(compressed):
+                        write_chunk(outfile, b'IDAT', compressed)
+                        idat_size += len(compressed)
+                    # Because of our very witty definition of ``extend``,
+                    # above, we must re-use the same ``data`` object.  Hence
+                    # we use ``del`` to empty this one, rather than create a
+                    # fresh one (which would be my natural FP instinct).
+                    del data[:]
+            if i < trial_rows:
+                filter_row, strategy = self.choose_filter(data, i+1,
+                                                          row_bytes)
+                _close_compressor(compressor[0])
+                compressor[0] = self.make_compressor(strategy=strategy)
+            if len(data):
+                compressed = compress(tostring(data))
+            else:
+                compressed = b''
+            flushed = flush()
+            if len(compressed) or len(flushed):
+                write_chunk(outfile, b'IDAT', compressed + flushed)
+            if syncs:
+                write_chunk(outfile, b'syNC',
+                            b''.join(struct.pack('!2I', *p) for p in syncs))
+            # http://www.w3.org/TR/PNG/#11IEND
+            write_chunk(outfile, b'IEND')
+            return i+1
+        finally:
+            # Stop the threads of a threaded compressor, even if the
+            # image was not finished.
+            _close_compressor(compressor[0])
+
+    def source_bitdepth(self):
+        """The bit depth of the samples supplied to the writer; this
+        differs from the bit depth of the PNG file when the samples
+        are rescaled (see the `bitdepth` argument of :class:`Writer`).
+        """
+
+        if self.rescale:
+            return self.rescale[0]
+        return self.bitdepth
+
+    def compression_settings(self):
+        """Return the ``zlib`` settings (*level*, *strategy*,
+        *memlevel*, *wbits*) for the `compression` argument.  The
+        *strategy* is ``None`` when it is to be picked by
+        :meth:`auto_strategy`.
+        """
+
+        if isinstance(self.compression, str):
+            profile = _compression_profiles[self.compression]
+            return (profile['level'], profile['strategy'],
+                    profile['memlevel'], profile['wbits'])
+        level = self.compression
+        if level is None:
+            level = -1
+        return level, zlib.Z_DEFAULT_STRATEGY, 8, zlib.MAX_WBITS
+
+    def auto_strategy(self, sample):
+        """Trial compress `sample`, the start of the (filtered) image
+        data, with each of the strategies that the ``'auto'`` profile
+        tries.  Returns (*size*, *strategy*) for the strategy that
+        compresses it best (the fastest, if there is a tie).
+        """
+
+        level, _, memlevel, wbits = self.compression_settings()
+        sample = bytes(sample[:_auto_sample_size])
+        results = []
+        for strategy in _auto_strategies:
+            start = _start()
+            c = zlib.compressobj(level, zlib.DEFLATED, wbits, memlevel,
+                                 strategy)
+            results.append((len(c.compress(sample) + c.flush()),
+                            strategy))
+            _record('deflate', start, len(sample))
+        return min(results, key=lambda result: result[0])
+
+    def choose_filter(self, data, rows, row_bytes):
+        """Used by :meth:`write_passes` for the ``'auto'`` profile.
+        `data` holds the first `rows` scanlines of the image,
+        unfiltered, each `row_bytes` long (with its filter type byte).
+        They are filtered in place, if that makes them compress
+        better.  Returns (*filter_row*, *strategy*): the function to
+        filter the remaining scanlines with (as for
+        :meth:`make_filter_row`, ``None`` if they are left unfiltered)
+        and the strategy to compress them with.
+        """
+
+        raw = array('B', data)
+        del data[:]
+        filter_row = self.make_filter_row(data)
+        for i in range(rows):
+            data.extend(raw[i*row_bytes:(i+1)*row_bytes])
+            filter_row(len(data) - row_bytes + 1, i)
+        filtered = self.auto_strategy(tostring(data))
+        unfiltered = self.auto_strategy(tostring(raw))
+        if unfiltered[0] <= filtered[0]:
+            data[:] = raw
+            return None, unfiltered[1]
+        return filter_row, filtered[1]
+
+    def make_compressor(self, sample=b'', strategy=None):
+        """Return a new object, with the interface of
+        ``zlib.compressobj``, for compressing the image data.
+        `sample`, the start of the (filtered) image data, is used to
+        pick the strategy for the ``'auto'`` profile, unless `strategy`
+        is given.
+        """
+
+        level, default, memlevel, wbits = self.compression_settings()
+        if strategy is None:
+            strategy = default
+        if strategy is None:
+            strategy = self.auto_strategy(sample)[1]
+        if self.workers and self.workers > 1:
+            if self.pool is None:
+                from concurrent.futures import ThreadPoolExecutor
+
+                self.pool = ThreadPoolExecutor(self.workers)
+            return _parallel_compressobj(level, self.workers,
+              pool=self.pool,
+              strategy=strategy, memlevel=memlevel, wbits=wbits)
+        return zlib.compressobj(level, zlib.DEFLATED, wbits, memlevel,
+                                strategy)
+
+    def make_filter_row(self, data):
+        """Return a function, used by :meth:`write_passes`, that
+        filters the scanline at the end of `data` (which is in
+        packed format, preceded by a placeholder filter type byte).
+        The function takes the offset into `data` at which the
+        scanline starts and the index of the scanline in the file.
+        Returns ``None`` when scanlines are left unfiltered.
+        """
+
+        # Filter offset, see :func:`filter_scanline`.
+        fo = max(1, int(self.psize))
+        # Index of the first scanline of each pass (reduced image).
+        # The first scanline of a pass has no previous scanline.
+        firsts = set([0])
+        if self.interlace:
+            y = 0
+            for xstart, ystart, xstep, ystep in _adam7:
+                if xstart >= self.width:
+                    continue
+                firsts.add(y)
+                y += len(range(ystart, self.height, ystep))
+        # Rows at sync points, which must not depend on the previous
+        # row.  Unlike the first row of a pass, a decoder reading the
+        # whole image still sees the previous row, so only filter
+        # types 0 and 1 are allowed.
+        syncs = set()
+        if self.sync_rows:
+            syncs = set(range(0, self.height, self.sync_rows))
+        filter_type = self.filter_type
+        if filter_type == 'adaptive' and (self.colormap or
+                                          self.bitdepth < 8):
+            # As the PNG specification recommends, colour mapped
+            # images and images with small bit depths are better left
+            # unfiltered.  See http://www.w3.org/TR/PNG/#12Filter-selection
+            filter_type = 0
+        if not filter_type:
+            return None
+        # The previous (unfiltered) scanline.
+        prev = [None]
+
+        def filter_row(start, i):
+            begin = _start()
+            line = data[start:]
+            if i in firsts or i in syncs:
+                prev[0] = None
+            if filter_type == 'adaptive':
+                types = ((0, 1, 2, 3, 4), (0, 1))[i in syncs]
+                filtered = filter_scanline_adaptive(line, fo, prev[0],
+                                                    types)
+            else:
+                type = filter_type
+                if i in syncs:
+                    # A type that does not use the previous row (with
+                    # no previous row, Paeth is the same as Sub).
+                    type = (0, 1, 0, 1, 1)[type]
+                filtered = filter_scanline(type, line, fo, prev[0])
+            data[start-1:] = filtered
+            prev[0] = line
+            _record('filter', begin, len(line))
+        return filter_row
 
     def write_array(self, outfile, pixels):
         """
@@ -832,9 +1405,8 @@ class Writer:
         if self.bitdepth > 8:
             assert self.bitdepth == 16
             row_bytes *= 2
-            fmt = '>%dH' % vpr
             def line():
-                return array('H', struct.unpack(fmt, infile.read(row_bytes)))
+                return unpack16(infile.read(row_bytes))
         else:
             def line():
                 scanline = array('B', infile.read(row_bytes))
@@ -862,9 +1434,27 @@ class Writer:
         the full source image in flat row flat pixel format.  The
         generator yields each scanline of the reduced passes in turn, in
         boxed row flat pixel format.
+        When NumPy is available each reduced image is extracted with a
+        strided view and copied into a contiguous array, whose rows
+        are yielded.
         """
 
         # http://www.w3.org/TR/PNG/#8InterlaceMethods
+        if numpy is not None:
+            if not isbuffer(pixels):
+                pixels = numpy.asarray(pixels)
+            a = sample_array(pixels, self.source_bitdepth())
+            a = a.reshape(self.height, self.width, self.planes)
+            for xstart, ystart, xstep, ystep in _adam7:
+                if xstart >= self.width:
+                    continue
+                reduced = a[ystart::ystep, xstart::xstep]
+                reduced = numpy.ascontiguousarray(reduced)
+                rows, ppr = reduced.shape[:2]
+                for row in reduced.reshape(rows, ppr * self.planes):
+                    yield row
+            return
+
         # Array type.
         fmt = 'BH'[self.bitdepth > 8]
         # Value per row
@@ -899,13 +1489,17 @@ def write_chunk(outfile, tag, data=b''):
     """
 
     # http://www.w3.org/TR/PNG/#5Chunk-layout
-    outfile.write(struct.pack("!I", len(data)))
-    outfile.write(tag)
-    outfile.write(data)
+    start = _start()
     checksum = zlib.crc32(tag)
     checksum = zlib.crc32(data, checksum)
     checksum &= 2**32-1
+    _record('crc', start, len(data))
+    start = _start()
+    outfile.write(struct.pack("!I", len(data)))
+    outfile.write(tag)
+    outfile.write(data)
     outfile.write(struct.pack("!I", checksum))
+    _record('chunk_write', start, len(data) + 12)
 
 def write_chunks(out, chunks):
     """Create a PNG file by writing out the chunks."""
@@ -914,6 +1508,128 @@ def write_chunks(out, chunks):
     for chunk in chunks:
         write_chunk(out, *chunk)
 
+def adler32_combine(adler1, adler2, len2):
+    """Return the Adler-32 checksum of the concatenation of two
+    sequences of bytes given the checksum of each, `adler1` and
+    `adler2`, and the length of the second, `len2`.  This is
+    ``adler32_combine`` from ``zlib`` (which Python does not expose).
+    """
+
+    # http://www.ietf.org/rfc/rfc1950.txt section 9
+    base = 65521
+    rem = len2 % base
+    sum1 = adler1 & 0xffff
+    sum2 = (rem * sum1) % base
+    sum1 = (sum1 + (adler2 & 0xffff) + base - 1) % base
+    sum2 = (sum2 + (adler1 >> 16) + (adler2 >> 16) + base - rem) % base
+    return (sum2 << 16) | sum1
+
+class _parallel_compressobj:
+    """
+    Like the object returned by ``zlib.compressobj``, but the data is
+    compressed in blocks by a pool of threads (``zlib`` releases the
+    GIL whilst compressing).  Each block is a raw deflate stream ended
+    at a full flush point, so that the blocks can simply be joined;
+    the ``zlib`` header and the Adler-32 checksum (combined from the
+    checksums of the blocks) are added here.
+    The blocks are compressed by `pool`, a
+    ``concurrent.futures.ThreadPoolExecutor``, if it is given (it is
+    left running); otherwise by a pool of `workers` threads made for
+    this object, which :meth:`close` shuts down.
+    """
+
+    def __init__(self, level=-1, workers=2, blocksize=2**17,
+                 strategy=zlib.Z_DEFAULT_STRATEGY, memlevel=8,
+                 wbits=zlib.MAX_WBITS, pool=None):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.level = level
+        self.strategy = strategy
+        self.memlevel = memlevel
+        self.wbits = wbits
+        self.blocksize = blocksize
+        self.own_pool = pool is None
+        if pool is None:
+            pool = ThreadPoolExecutor(workers)
+        self.pool = pool
+        # Limit the number of blocks in flight, to bound memory use.
+        self.maxpending = 2 * workers
+        self.pending = deque()
+        self.buffer = bytearray()
+        # The zlib header depends only on these settings.
+        self.header = zlib.compressobj(level, zlib.DEFLATED, wbits,
+                                       memlevel, strategy).flush()[:2]
+        self.adler = 1
+
+    def _block(self, data, last):
+        """Compress one block (in a worker thread)."""
+
+        c = zlib.compressobj(self.level, zlib.DEFLATED, -self.wbits,
+                             self.memlevel, self.strategy)
+        out = c.compress(data)
+        out += c.flush((zlib.Z_FULL_FLUSH, zlib.Z_FINISH)[last])
+        return out, zlib.adler32(data), len(data)
+
+    def _collect(self, wait):
+        """Return the compressed output of the finished blocks at the
+        front of the queue; when `wait` is true, wait for all of them.
+        """
+
+        out = []
+        while self.pending and (wait or self.pending[0].done() or
+                                len(self.pending) > self.maxpending):
+            compressed, adler, length = self.pending.popleft().result()
+            self.adler = adler32_combine(self.adler, adler, length)
+            out.append(compressed)
+        if out and self.header:
+            out.insert(0, self.header)
+            self.header = b''
+        return b''.join(out)
+
+    def compress(self, data):
+        self.buffer += data
+        while len(self.buffer) > self.blocksize:
+            block = bytes(self.buffer[:self.blocksize])
+            del self.buffer[:self.blocksize]
+            self.pending.append(self.pool.submit(self._block, block, False))
+        return self._collect(False)
+
+    def flush(self, mode=zlib.Z_FINISH):
+        block = bytes(self.buffer)
+        del self.buffer[:]
+        last = mode == zlib.Z_FINISH
+        self.pending.append(self.pool.submit(self._block, block, last))
+        if not last:
+            # Every block already ends at a full flush point.
+            return self._collect(True)
+        try:
+            out = self._collect(True)
+        finally:
+            self.close()
+        return out + struct.pack('!I', self.adler & 0xffffffff)
+
+    def close(self):
+        """Abandon the blocks that have not been compressed yet, and
+        shut down the pool of threads if it was made for this object.
+        Called by ``flush(zlib.Z_FINISH)``; calling it again does
+        nothing.
+        """
+
+        while self.pending:
+            self.pending.popleft().cancel()
+        if self.own_pool and self.pool is not None:
+            self.pool.shutdown()
+        self.pool = None
+
+def _close_compressor(compressor):
+    """Close `compressor`, as made by :meth:`Writer.make_compressor`,
+    if it needs closing (a ``zlib`` compressor does not), so that no
+    threads are left running.  `compressor` may be ``None``.
+    """
+
+    if hasattr(compressor, 'close'):
+        compressor.close()
+
 def filter_scanline(type, line, fo, prev=None):
     """Apply a scanline filter to a scanline.  `type` specifies the
     filter type (0 to 4); `line` specifies the current (unfiltered)
@@ -922,82 +1638,39 @@ def filter_scanline(type, line, fo, prev=None):
     filter offset; normally this is size of a pixel in bytes (the number
     of bytes per sample times the number of channels), but when this is
     < 1 (for bit depths < 8) then the filter offset is 1.
+    The scanline is filtered by the active filter backend (see
+    :func:`use_filter_backend`) or, if it cannot filter, by the
+    pure-Python reference, :meth:`pngfilters.filter_scanline`.
     """
 
     assert 0 <= type < 5
 
-    # The output array.  Which, pathetically, we extend one-byte at a
-    # time (fortunately this is linear).
+    candidates = _backend_function('filter_candidates')
+    if candidates is None:
+        return pngfilters.filter_scanline(type, line, fo, prev)
+    filtered = candidates(fo, line, prev or None)
     out = array('B', [type])
+    out.frombytes(filtered[type].tobytes())
+    return out
 
-    def sub():
-        ai = -fo
-        for x in line:
-            if ai >= 0:
-                x = (x - line[ai]) & 0xff
-            out.append(x)
-            ai += 1
-    def up():
-        for i,x in enumerate(line):
-            x = (x - prev[i]) & 0xff
-            out.append(x)
-    def average():
-        ai = -fo
-        for i,x in enumerate(line):
-            if ai >= 0:
-                x = (x - ((line[ai] + prev[i]) >> 1)) & 0xff
-            else:
-                x = (x - (prev[i] >> 1)) & 0xff
-            out.append(x)
-            ai += 1
-    def paeth():
-        # http://www.w3.org/TR/PNG/#9Filter-type-4-Paeth
-        ai = -fo # also used for ci
-        for i,x in enumerate(line):
-            a = 0
-            b = prev[i]
-            c = 0
-
-            if ai >= 0:
-                a = line[ai]
-                c = prev[ai]
-            p = a + b - c
-            pa = abs(p - a)
-            pb = abs(p - b)
-            pc = abs(p - c)
-            if pa <= pb and pa <= pc:
-                Pr = a
-            elif pb <= pc:
-                Pr = b
-            else:
-                Pr = c
-
-            x = (x - Pr) & 0xff
-            out.append(x)
-            ai += 1
+def filter_scanline_adaptive(line, fo, prev=None, types=(0, 1, 2, 3, 4)):
+    """Apply whichever scanline filter makes the scanline smallest,
+    by the minimum sum of absolute differences heuristic: each
+    filtered byte is regarded as a signed difference, and the filter
+    type with the smallest sum of absolute values is chosen.  See
+    http://www.w3.org/TR/PNG/#12Filter-selection .  Only the filter
+    types in `types` are considered.  The other arguments and the
+    result are as for :func:`filter_scanline`.
+    """
 
-    if not prev:
-        # We're on the first line.  Some of the filters can be reduced
-        # to simpler cases which makes handling the line "off the top"
-        # of the image simpler.  "up" becomes "none"; "paeth" becomes
-        # "left" (non-trivial, but true). "average" needs to be handled
-        # specially.
-        if type == 2: # "up"
-            type = 0
-        elif type == 3:
-            prev = [0]*len(line)
-        elif type == 4: # "paeth"
-            type = 1
-    if type == 0:
-        out.extend(line)
-    elif type == 1:
-        sub()
-    elif type == 2:
-        up()
-    elif type == 3:
-        average()
-    else: # type == 4
-        paeth()
+    candidates = _backend_function('filter_candidates')
+    if candidates is None:
+        return pngfilters.filter_scanline_adaptive(line, fo, prev, types)
+    filtered = candidates(fo, line, prev or None)
+    d = filtered[list(types)].astype(numpy.int32)
+    type = types[int(numpy.minimum(d, 256 - d).sum(axis=1).argmin())]
+    out = array('B', [type])
+    out.frombytes(filtered[type].tobytes())
     return out
 
 
@@ -1151,7 +1824,11 @@ def from_array(a, mode=None, info={}):
 
     if threed:
         # Flatten the threed rows
-        a = (itertools.chain.from_iterable(x) for x in a)
+        def flatten(x):
+            if numpy is not None and isinstance(x, numpy.ndarray):
+                return x.reshape(-1)
+            return itertools.chain.from_iterable(x)
+        a = map(flatten, a)
 
     if 'bitdepth' not in info:
         try:
@@ -1220,24 +1897,342 @@ class Image:
         try:
             w.write(file, self.rows)
         finally:
+            w.close()
             close()
 
+class StripWriter:
+    """
+    PNG encoder that is given the image a strip (a band of rows) at a
+    time, for images too large to hold in memory.  Each strip is
+    filtered and compressed in a background thread whilst the caller
+    prepares the next one, so that at most two strips are held at
+    once (one being compressed, one being prepared), together with
+    the ``zlib`` window and less than `chunk_limit` bytes of
+    compressed data::
+
+        with png.StripWriter(out, width, height) as w:
+            for y in range(0, height, 256):
+                w.write_strip(render(y, 256))
+    """
+
+    def __init__(self, outfile, *args, **kw):
+        """
+        `outfile` is the file to write the PNG image to.  The other
+        arguments are those of :class:`Writer`; `interlace` is not
+        supported, as an interlaced image can only be written when all
+        of it is available.
+        """
+
+        self.writer = Writer(*args, **kw)
+        if self.writer.interlace:
+            raise ValueError("interlace not compatible with StripWriter")
+        self.outfile = outfile
+        # Number of rows supplied so far.
+        self.rows = 0
+        self.error = None
+        self.closed = False
+        # Whether the encoder has taken the end marker from the queue.
+        self.ended = False
+        # Holds the strip handed over by :meth:`write_strip` until
+        # the encoder has finished with the previous one.
+        self.queue = queue.Queue(1)
+        self.thread = threading.Thread(target=self._encode)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _take(self):
+        """Take the next strip (``None`` after the last one) from the
+        queue (in the encoder's thread).
+        """
+
+        strip = self.queue.get()
+        self.queue.task_done()
+        if strip is None:
+            self.ended = True
+        return strip
+
+    def _iterrows(self):
+        while True:
+            strip = self._take()
+            if strip is None:
+                return
+            for row in strip:
+                yield row
+
+    def _encode(self):
+        try:
+            self.writer.write_passes(self.outfile, self._iterrows())
+        except Exception as e:
+            self.error = e
+            # Discard the remaining strips, so that :meth:`write_strip`
+            # and :meth:`close` are not kept waiting.
+            while not self.ended:
+                self._take()
+        finally:
+            # The writer is used for just this one image.
+            self.writer.close()
+
+    def write_strip(self, block):
+        """Add the rows of `block`, the next strip of the image, to
+        the image.  `block` is a NumPy array with shape (*rows*,
+        ``width * planes``) or (*rows*, *width*, *planes*), or a
+        sequence of rows in boxed row flat pixel format.  Strips can
+        have any number of rows.
+        Returns when the encoder has started on `block` (having
+        finished with the previous strip), so the caller can prepare
+        the next strip whilst this one is compressed.  `block` must
+        not be changed until the next call to :meth:`write_strip` or
+        :meth:`close` has returned.
+        """
+
+        if self.closed:
+            raise Error("write_strip called after close")
+        if self.error is not None:
+            raise self.error
+        vpr = self.writer.width * self.writer.planes
+        if numpy is not None and isinstance(block, numpy.ndarray):
+            if block.ndim == 3:
+                block = block.reshape(len(block), -1)
+            if block.ndim != 2 or block.shape[1] != vpr:
+                raise ValueError("strip has shape %r, expected (rows, %d)"
+                                 % (block.shape, vpr))
+        if self.rows + len(block) > self.writer.height:
+            raise ValueError(
+              "rows supplied (%d) exceeds height (%d)" %
+              (self.rows + len(block), self.writer.height))
+        self.rows += len(block)
+        self.queue.put(block)
+        self.queue.join()
+
+    def close(self):
+        """Finish writing the image, once all of its rows have been
+        supplied.  Does not close `outfile`.
+        """
+
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+        if self.rows != self.writer.height:
+            raise ValueError(
+              "rows supplied (%d) does not match height (%d)" %
+              (self.rows, self.writer.height))
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+            return
+        # The image is incomplete; stop the encoder, without hiding
+        # the exception that caused it.
+        try:
+            self.close()
+        except Exception:
+            pass
+
+class Encoder:
+    """
+    Reusable PNG encoder, for encoding many images of the same size
+    and format (such as tiles) quickly.  The arguments are checked,
+    and the chunks that come before the image data are made, only
+    once.  A ``zlib`` compressor is made for the first image and
+    copied (with ``compressobj.copy``) for each image after that,
+    and the image data is filtered, as a whole, into a buffer that is
+    reused::
+
+        encoder = png.Encoder(256, 256, greyscale=True)
+        for tile in tiles:
+            data = encoder.encode(tile)
+
+    Images are encoded this way when the active filter backend can
+    filter whole blocks of scanlines (the ``'numpy'`` one can, see
+    :func:`use_filter_backend`) and they are given as a NumPy array,
+    or another buffer, of the image's samples, for an image that is
+    not interlaced and has no `sync_rows`.  Anything else is passed
+    to :meth:`Writer.write`.
+    With the ``'auto'`` and ``'smallest'`` profiles (see
+    :class:`Writer`), the filtering and the ``zlib`` strategy are
+    picked using the first image, and used for all of them.
+    An :class:`Encoder` must not be used by more than one thread at a
+    time.
+    """
+
+    def __init__(self, *args, **kw):
+        """The arguments are those of :class:`Writer`."""
+
+        self.writer = w = Writer(*args, **kw)
+        out = io.BytesIO()
+        w.write_preamble(out)
+        self.preamble = out.getvalue()
+        out = io.BytesIO()
+        write_chunk(out, b'IEND')
+        self.end = out.getvalue()
+        self.fast = (numpy is not None and not w.interlace and
+                     not w.sync_rows)
+        # Made for the first image, see :meth:`prime`.
+        self.compressor = None
+        self.strategy = None
+        self.filter_type = w.filter_type
+        if self.filter_type == 'adaptive' and (w.colormap or
+                                               w.bitdepth < 8):
+            self.filter_type = 0
+        # Filtered image data, with the filter type byte of each row.
+        self.buffer = None
+
+    def samples(self, pixels):
+        """Convert `pixels`, a buffer of all the samples of an image,
+        to a 2-dimensional uint8 array of its scanlines (packed, and
+        with 16-bit samples big-endian).
+        """
+
+        w = self.writer
+        a = sample_array(pixels, w.source_bitdepth())
+        vpr = w.width * w.planes
+        if len(a) != vpr * w.height:
+            raise ValueError("pixels has %d samples, expected %d" %
+                             (len(a), vpr * w.height))
+        if w.rescale:
+            factor = \
+              float(2**w.rescale[1]-1) / float(2**w.rescale[0]-1)
+            a = numpy.rint(factor*a).astype(a.dtype)
+        a = a.reshape(w.height, vpr)
+        if w.bitdepth == 16:
+            return a.astype('>u2').view(numpy.uint8)
+        if w.bitdepth < 8:
+            return numpy.frombuffer(pack_samples(a, w.bitdepth),
+                                    numpy.uint8).reshape(w.height, -1)
+        return a
+
+    def prime(self, block, fo):
+        """Make the compressor that is copied for each image, using
+        `block`, the scanlines of the first image, to pick the filter
+        type and strategy for the ``'auto'`` and ``'smallest'``
+        profiles.
+        """
+
+        w = self.writer
+        filter_rows = _backend_function('filter_rows')
+        strategy = w.compression_settings()[1]
+        if w.trial_filter:
+            choices = []
+            for filter_type in (0, 'adaptive'):
+                filtered = filter_rows(fo, block, filter_type)
+                size, best = w.auto_strategy(filtered.tobytes())
+                choices.append((size, best, filter_type))
+            # Ties favour leaving the image unfiltered.
+            size, strategy, self.filter_type = min(
+              choices, key=lambda choice: choice[0])
+        elif strategy is None:
+            filtered = filter_rows(fo, block, self.filter_type)
+            strategy = w.auto_strategy(filtered.tobytes())[1]
+        self.strategy = strategy
+        self.compressor = w.make_compressor(strategy=strategy)
+
+    def write(self, outfile, pixels):
+        """Write a PNG image of `pixels` to `outfile`.  `pixels` is
+        as for :meth:`Writer.write_array` (a flat sequence, or array,
+        of all the samples) or, when it is not a buffer, as for
+        :meth:`Writer.write`.
+        """
+
+        w = self.writer
+        filter_rows = _backend_function('filter_rows')
+        if not (self.fast and filter_rows and isbuffer(pixels)):
+            if isarray(pixels):
+                return w.write_array(outfile, pixels)
+            return w.write(outfile, pixels)
+        block = self.samples(pixels)
+        fo = max(1, int(w.psize))
+        if self.compressor is None:
+            self.prime(block, fo)
+        start = _start()
+        shape = (len(block), block.shape[1] + 1)
+        if self.buffer is None or self.buffer.shape != shape:
+            self.buffer = numpy.empty(shape, numpy.uint8)
+        if self.filter_type:
+            filter_rows(fo, block, self.filter_type, self.buffer)
+        else:
+            self.buffer[:, 0] = 0
+            self.buffer[:, 1:] = block
+        _record('filter', start, block.nbytes)
+        start = _start()
+        if hasattr(self.compressor, 'copy'):
+            compressor = self.compressor.copy()
+        else:
+            # The threaded compressor cannot be copied.
+            compressor = w.make_compressor(strategy=self.strategy)
+        try:
+            compressed = compressor.compress(
+              memoryview(self.buffer.reshape(-1)))
+            compressed += compressor.flush()
+        finally:
+            _close_compressor(compressor)
+        _record('deflate', start, self.buffer.nbytes)
+        outfile.write(self.preamble)
+        write_chunk(outfile, b'IDAT', compressed)
+        outfile.write(self.end)
+
+    def encode(self, pixels):
+        """Return a PNG image of `pixels` (as for :meth:`write`), as
+        a ``bytes`` object.
+        """
+
+        out = io.BytesIO()
+        self.write(out, pixels)
+        return out.getvalue()
+
+    def close(self):
+        """Shut down the pool of threads used when `workers` is more
+        than 1 (see :meth:`Writer.close`).
+        """
+
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
 class _readable:
     """
-    A simple file-like interface for strings and arrays.
+    A simple file-like interface for strings, arrays, memory maps, and
+    anything else that supports the buffer protocol.  :meth:`read`
+    returns ``memoryview`` slices of the buffer, so nothing is copied.
     """
 
     def __init__(self, buf):
-        self.buf = buf
+        self.buf = memoryview(buf).cast('B')
         self.offset = 0
 
     def read(self, n):
         r = self.buf[self.offset:self.offset+n]
-        if isarray(r):
-            r = r.tostring()
         self.offset += n
         return r
 
+    def seek(self, offset, whence=0):
+        self.offset = (0, self.offset, len(self.buf))[whence] + offset
+        return self.offset
+
+    def tell(self):
+        return self.offset
+
+def _mmapfile(f):
+    """Memory map the open file `f` (read only).  Returns ``None``
+    if it cannot be mapped (for example, because it is empty or is
+    not a regular file).
+    """
+
+    try:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, ValueError, OSError):
+        return None
+
 try:
     str(b'dummy', 'ascii')
 except TypeError:
@@ -1251,7 +2246,7 @@ class Reader:
     PNG decoder in pure Python.
     """
 
-    def __init__(self, _guess=None, **kw):
+    def __init__(self, _guess=None, mmap=False, buffer_rows=8, **kw):
         """
         Create a PNG decoder object.
         The constructor expects exactly one keyword argument. If you
@@ -1262,7 +2257,24 @@ class Reader:
         file
           A file-like object (object with a read() method).
         bytes
-          ``array`` or ``string`` with PNG data.
+          ``array``, ``string``, ``mmap``, or any other object that
+          supports the buffer protocol, with PNG data.
+        If `mmap` is true then an input file (`filename` or `file`) is
+        memory mapped, if possible, and read in the same way as
+        `bytes`: the ``IDAT`` data is passed straight from the mapped
+        file to ``zlib``, as ``memoryview`` slices, without being
+        copied; on network file systems this also saves the overhead
+        of a read call per chunk.
+        `buffer_rows` limits how much image data is decompressed at a
+        time, in scanlines: however large the image (and however well
+        the data compresses), reading a straightlaced image only holds
+        a few times this many scanlines of decompressed data in memory.
+        With the NumPy filter backend, larger values (such as 128) make
+        decoding images filtered mostly with the "average" and "Paeth"
+        filters several times faster, as the scanlines of each piece
+        are unfiltered together (see :meth:`npfilters.undo_filter_rows`).
+        A file opened from `filename`, and a memory mapping, are closed
+        when the ``IEND`` chunk has been read, or by :meth:`close`.
         """
         if ((_guess is not None and len(kw) != 0) or
             (_guess is None and len(kw) != 1)):
@@ -1276,24 +2288,74 @@ class Reader:
         # past the 4 bytes that specify the chunk type).  See preamble
         # method for how this is used.
         self.atchunk = None
+        self.buffer_rows = buffer_rows
 
         if _guess is not None:
-            if isarray(_guess):
+            if isarray(_guess) or isbuffer(_guess):
+                # Includes ``bytes`` and ``mmap`` objects.
                 kw["bytes"] = _guess
-            elif isinstance(_guess, str):
+            elif isinstance(_guess, (str, os.PathLike)):
                 kw["filename"] = _guess
             elif hasattr(_guess, 'read'):
                 kw["file"] = _guess
 
+        # What the image is read from, for :meth:`cache_key`.
+        self.source = None
+        # The file that the Reader opened itself, and the memory
+        # mapping, which :meth:`close` closes.
+        self.opened = None
+        self.mapped = None
         if "filename" in kw:
-            self.file = open(kw["filename"], "rb")
+            self.file = self.opened = open(kw["filename"], "rb")
+            st = os.fstat(self.file.fileno())
+            self.source = ('file', os.path.abspath(kw["filename"]),
+                           st.st_size, st.st_mtime_ns)
         elif "file" in kw:
             self.file = kw["file"]
         elif "bytes" in kw:
             self.file = _readable(kw["bytes"])
+            self.source = ('bytes', self.file.buf)
         else:
             raise TypeError("expecting filename, file or bytes array")
+        if mmap and not isinstance(self.file, _readable):
+            mapped = _mmapfile(self.file)
+            if mapped is not None:
+                # Start from the file's current position, as reading
+                # it would.
+                mapped.seek(self.file.tell())
+                self.file = _readable(mapped)
+                self.file.offset = mapped.tell()
+                self.mapped = mapped
+                # The mapping does not need the file to stay open.
+                if self.opened is not None:
+                    self.opened.close()
+                    self.opened = None
+
+    def close(self):
+        """Close the file, if the Reader opened it (when created with
+        `filename`), and the memory mapping, if there is one.  If
+        ``IDAT`` data is still in use as ``memoryview`` slices of the
+        mapping, the mapping stays open, and calling this method again
+        once they have gone closes it.
+        """
+
+        if self.opened is not None:
+            self.opened.close()
+            self.opened = None
+        if self.mapped is not None:
+            self.file.buf.release()
+            try:
+                self.mapped.close()
+            except BufferError:
+                # Slices are still in use.
+                return
+            self.mapped = None
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
 
     def chunk(self, seek=None, lenient=False):
         """
@@ -1310,6 +2372,15 @@ class Reader:
         checksum failures will raise warnings rather than exceptions.
         """
 
+        type, data = self._chunk(seek, lenient)
+        return type, bytes(data)
+
+    def _chunk(self, seek=None, lenient=False):
+        """Like :meth:`chunk`, but when reading from `bytes` or a
+        memory mapped file the data of an ``IDAT`` chunk is returned
+        as a ``memoryview`` slice, for :meth:`iteridat`.
+        """
+
         self.validate_signature()
 
         while True:
@@ -1318,34 +2389,56 @@ class Reader:
                 self.atchunk = self.chunklentype()
             length, type = self.atchunk
             self.atchunk = None
+            start = _start()
             data = self.file.read(length)
             if len(data) != length:
                 raise ChunkError('Chunk %s too short for required %i octets.'
                   % (type, length))
-            checksum = self.file.read(4)
+            checksum = bytes(self.file.read(4))
             if len(checksum) != 4:
                 raise ChunkError('Chunk %s too short for checksum.' % type)
+            _record('chunk_read', start, length + 4)
             if seek and type != seek:
                 continue
-            verify = zlib.crc32(type)
-            verify = zlib.crc32(data, verify)
-            # Whether the output from zlib.crc32 is signed or not varies
-            # according to hideous implementation details, see
-            # http://bugs.python.org/issue1202 .
-            # We coerce it to be positive here (in a way which works on
-            # Python 2.3 and older).
-            verify &= 2**32 - 1
-            verify = struct.pack('!I', verify)
-            if checksum != verify:
-                (a, ) = struct.unpack('!I', checksum)
-                (b, ) = struct.unpack('!I', verify)
-                message = "Checksum error in %s chunk: 0x%08X != 0x%08X." % (type, a, b)
-                if lenient:
-                    warnings.warn(message, RuntimeWarning)
-                else:
-                    raise ChunkError(message)
+            self.verify_checksum(type, data, checksum, lenient=lenient)
+            if type != b'IDAT':
+                # Other chunks are small, and may be kept (in
+                # `self.plte` for example): a copy does not pin the
+                # mapping.
+                data = bytes(data)
+            if type == b'IEND':
+                # http://www.w3.org/TR/PNG/#11IEND
+                # Nothing follows it.
+                self.close()
             return type, data
 
+    def verify_checksum(self, type, data, checksum, lenient=False):
+        """Check `checksum`, the 4 bytes that follow a chunk in the
+        file, against the chunk's `type` and `data`.  Raises
+        :class:`ChunkError` if they do not match, unless `lenient` is
+        true, when a warning is given instead.
+        """
+
+        start = _start()
+        verify = zlib.crc32(type)
+        verify = zlib.crc32(data, verify)
+        _record('crc', start, len(data))
+        # Whether the output from zlib.crc32 is signed or not varies
+        # according to hideous implementation details, see
+        # http://bugs.python.org/issue1202 .
+        # We coerce it to be positive here (in a way which works on
+        # Python 2.3 and older).
+        verify &= 2**32 - 1
+        verify = struct.pack('!I', verify)
+        if checksum != verify:
+            (a, ) = struct.unpack('!I', checksum)
+            (b, ) = struct.unpack('!I', verify)
+            message = "Checksum error in %s chunk: 0x%08X != 0x%08X." % (type, a, b)
+            if lenient:
+                warnings.warn(message, RuntimeWarning)
+            else:
+                raise ChunkError(message)
+
     def chunks(self):
         """Return an iterator that will yield each chunk as a
         (*chunktype*, *content*) pair.
@@ -1458,13 +2551,14 @@ class Reader:
                 result[i] = (x + pr) & 0xff
                 ai += 1
 
-        # Call appropriate filter algorithm.  Note that 0 has already
-        # been dealt with.
+        # Call appropriate filter algorithm (from the active filter
+        # backend).  Note that 0 has already been dealt with.
+        filters = _filter_backends[_filter_backend]
         (None,
-         pngfilters.undo_filter_sub,
-         pngfilters.undo_filter_up,
-         pngfilters.undo_filter_average,
-         pngfilters.undo_filter_paeth)[filter_type](fu, scanline, previous, result)
+         filters.undo_filter_sub,
+         filters.undo_filter_up,
+         filters.undo_filter_average,
+         filters.undo_filter_paeth)[filter_type](fu, scanline, previous, result)
         return result
 
     def deinterlace(self, raw):
@@ -1473,13 +2567,18 @@ class Reader:
         Return in flat row flat pixel format.
         """
 
+        fmt = 'BH'[self.bitdepth > 8]
+        if _filter_backend == 'numpy':
+            a = array(fmt)
+            a.frombytes(self.deinterlace_array(raw).tobytes())
+            return a
+
         # Values per row (of the target image)
         vpr = self.width * self.planes
 
         # Make a result array, and make it big enough.  Interleaving
         # writes to the output array randomly (well, not quite), so the
         # entire output array must be in memory.
-        fmt = 'BH'[self.bitdepth > 8]
         a = array(fmt, [0]*vpr*self.height)
         source_offset = 0
 
@@ -1499,7 +2598,9 @@ class Reader:
                 source_offset += 1
                 scanline = raw[source_offset:source_offset+row_size]
                 source_offset += row_size
+                start = _start()
                 recon = self.undo_filter(filter_type, scanline, recon)
+                _record('unfilter', start, row_size)
                 # Convert so that there is one element per pixel value
                 flat = self.serialtoflat(recon, ppr)
                 if xstep == 1:
@@ -1515,6 +2616,52 @@ class Reader:
                             flat[i::self.planes]
         return a
 
+    def deinterlace_array(self, raw, max_pass=7, reduced=False):
+        """
+        Like :meth:`deinterlace`, but returns the image as a NumPy
+        array with shape (*height*, *width*, *planes*).  Each reduced
+        (pass) image is unfiltered and unpacked as a single block, then
+        scattered into place with one strided assignment.  `raw` must be
+        writable; it is unfiltered in place.  Only the first `max_pass`
+        passes are decoded (`raw` need only hold those); the pixels of
+        the later passes are left as 0.  If `reduced` is true, the
+        result holds only the pixels that those passes provide (every
+        8th pixel across and down after pass 1, and so on; see
+        :meth:`read_preview`), so it is smaller than the image.
+        Requires NumPy.
+        """
+
+        fu = max(1, self.psize)
+        dtype = (numpy.uint8, numpy.uint16)[self.bitdepth > 8]
+        if reduced:
+            # Every pass up to `max_pass` starts, and steps, on
+            # multiples of this grid.
+            xgrid, ygrid = _adam7_grid[max_pass - 1]
+        else:
+            xgrid = ygrid = 1
+        out = numpy.zeros((-(-self.height // ygrid),
+                           -(-self.width // xgrid), self.planes), dtype)
+        raw = _npbytes(raw)
+        source_offset = 0
+        for grid, rows, ppr, row_size in self._pass_sizes(max_pass):
+            xstart, ystart, xstep, ystep = grid
+            # With the filter type byte.
+            row_size += 1
+            end = source_offset + rows * row_size
+            if end > len(raw):
+                raise FormatError(
+                  'Wrong size for decompressed IDAT chunk.')
+            block = raw[source_offset:end].reshape(rows, row_size)
+            source_offset = end
+            start = _start()
+            block = npfilters.undo_filter_rows(fu, block)
+            _record('unfilter', start, block.nbytes)
+            samples = self.unpack_block(block, ppr)
+            out[ystart // ygrid::ystep // ygrid,
+                xstart // xgrid::xstep // xgrid] = \
+                samples.reshape(rows, ppr, self.planes)
+        return out
+
     def iterboxed(self, rows):
         """Iterator that yields each scanline in boxed row flat pixel
         format.  `rows` should be an iterator that yields the bytes of
@@ -1527,22 +2674,20 @@ class Reader:
             argument.
             """
 
+            start = _start()
+            # Rows may be ``array`` or NumPy arrays; as bytes they
+            # convert quickly in both cases.
+            raw = tostring(raw)
             if self.bitdepth == 8:
-                return array('B', raw)
-            if self.bitdepth == 16:
-                raw = tostring(raw)
-                return array('H', struct.unpack('!%dH' % (len(raw)//2), raw))
-            assert self.bitdepth < 8
-            width = self.width
-            # Samples per byte
-            spb = 8//self.bitdepth
-            out = array('B')
-            mask = 2**self.bitdepth - 1
-            shifts = [self.bitdepth * i
-                for i in reversed(list(range(spb)))]
-            for o in raw:
-                out.extend([mask&(o>>i) for i in shifts])
-            return out[:width]
+                out = array('B', raw)
+            elif self.bitdepth == 16:
+                out = unpack16(raw)
+            else:
+                assert self.bitdepth < 8
+                out = array('B', unpack_samples(raw, self.bitdepth,
+                                                self.width))
+            _record('unpack', start, len(raw))
+            return out
 
         return map(asvalues, rows)
 
@@ -1553,24 +2698,15 @@ class Reader:
 
         if self.bitdepth == 8:
             return bytes
+        start = _start()
         if self.bitdepth == 16:
-            bytes = tostring(bytes)
-            return array('H',
-              struct.unpack('!%dH' % (len(bytes)//2), bytes))
-        assert self.bitdepth < 8
-        if width is None:
-            width = self.width
-        # Samples per byte
-        spb = 8//self.bitdepth
-        out = array('B')
-        mask = 2**self.bitdepth - 1
-        shifts = list(map(self.bitdepth.__mul__, reversed(list(range(spb)))))
-        l = width
-        for o in bytes:
-            out.extend([(mask&(o>>s)) for s in shifts][:l])
-            l -= spb
-            if l <= 0:
-                l = width
+            out = unpack16(bytes)
+        else:
+            assert self.bitdepth < 8
+            if width is None:
+                width = self.width
+            out = array('B', unpack_samples(bytes, self.bitdepth, width))
+        _record('unpack', start, len(bytes))
         return out
 
     def iterstraight(self, raw):
@@ -1580,27 +2716,81 @@ class Reader:
         that yields the raw bytes in chunks of arbitrary size.
         """
 
-        # length of row, in bytes
-        rb = self.row_bytes
-        a = array('B')
+        unfilter = self.unfilterer()
+        for some in raw:
+            for row in unfilter(some):
+                yield row
+        unfilter(None)
+
+    def iterstraight_blocks(self, raw):
+        """Like :meth:`iterstraight` but, instead of one row at a time,
+        yields blocks of rows as 2-dimensional NumPy arrays (one
+        scanline per row) holding all the complete scanlines that each
+        piece of `raw` makes available.  Requires NumPy.
+        """
+
+        unfilter = self.unfilterer(blocks=True)
+        for some in raw:
+            for block in unfilter(some):
+                yield block
+        unfilter(None)
+
+    def unfilterer(self, blocks=False):
+        """Return a function that undoes the filtering of a
+        straightlaced image a piece at a time.  Call it with each piece
+        of the decompressed data in turn; it returns a list of the
+        scanlines that the piece completes, in serialised format (as
+        yielded by :meth:`iterstraight`) or, if `blocks` is true, as
+        blocks of scanlines (as yielded by :meth:`iterstraight_blocks`,
+        which requires NumPy).  Call it with ``None`` after the last
+        piece, to check that the data made whole scanlines.
+        """
+
+        # length of row, in bytes, including the filter type byte
+        rb = self.row_bytes + 1
+        fu = max(1, self.psize)
+        use_numpy = blocks or _filter_backend == 'numpy'
+        a = bytearray()
         # The previous (reconstructed) scanline.  None indicates first
         # line of image.
-        recon = None
-        for some in raw:
+        recon = [None]
+
+        def unfilter(some):
+            if some is None:
+                if len(a) != 0:
+                    # :file:format We get here with a file format error:
+                    # when the available bytes (after decompressing) do
+                    # not pack into exact rows.
+                    raise FormatError(
+                      'Wrong size for decompressed IDAT chunk.')
+                return []
             a.extend(some)
-            while len(a) >= rb + 1:
-                filter_type = a[0]
-                scanline = a[1:rb+1]
-                del a[:rb+1]
-                recon = self.undo_filter(filter_type, scanline, recon)
-                yield recon
-        if len(a) != 0:
-            # :file:format We get here with a file format error:
-            # when the available bytes (after decompressing) do not
-            # pack into exact rows.
-            raise FormatError(
-              'Wrong size for decompressed IDAT chunk.')
-        assert len(a) == 0
+            n = len(a) // rb
+            if not n:
+                return []
+            start = _start()
+            if use_numpy:
+                # Slicing the bytearray copies the complete rows out, so
+                # that `a` can be trimmed while the block is in use.
+                block = numpy.frombuffer(a[:n*rb], dtype=numpy.uint8)
+                del a[:n*rb]
+                block = npfilters.undo_filter_rows(
+                  fu, block.reshape(n, rb), recon[0])
+                recon[0] = block[-1]
+                if blocks:
+                    rows = [block]
+                else:
+                    rows = list(block)
+            else:
+                rows = []
+                for i in range(0, n*rb, rb):
+                    scanline = array('B', a[i+1:i+rb])
+                    recon[0] = self.undo_filter(a[i], scanline, recon[0])
+                    rows.append(recon[0])
+                del a[:n*rb]
+            _record('unfilter', start, n*rb)
+            return rows
+        return unfilter
 
     def validate_signature(self):
         """If signature (header) has not been read then read and
@@ -1609,7 +2799,7 @@ class Reader:
 
         if self.signature:
             return
-        self.signature = self.file.read(8)
+        self.signature = bytes(self.file.read(8))
         if self.signature != _signature:
             raise FormatError("PNG file has invalid signature.")
 
@@ -1793,53 +2983,281 @@ class Reader:
         checksum failures will raise warnings rather than exceptions.
         """
 
-        def iteridat():
-            """Iterator that yields all the ``IDAT`` chunks as strings."""
-            while True:
-                try:
-                    type, data = self.chunk(lenient=lenient)
-                except ValueError as e:
-                    raise ChunkError(e.args[0])
-                if type == b'IEND':
-                    # http://www.w3.org/TR/PNG/#11IEND
-                    break
-                if type != b'IDAT':
-                    continue
-                # type == b'IDAT'
-                # http://www.w3.org/TR/PNG/#11IDAT
-                if self.colormap and not self.plte:
-                    warnings.warn("PLTE chunk is required before IDAT chunk")
-                yield data
-
-        def iterdecomp(idat):
-            """Iterator that yields decompressed strings.  `idat` should
-            be an iterator that yields the ``IDAT`` chunk data.
-            """
-
-            # Currently, with no max_length parameter to decompress,
-            # this routine will do one yield per IDAT chunk: Not very
-            # incremental.
-            d = zlib.decompressobj()
-            # Each IDAT chunk is passed to the decompressor, then any
-            # remaining state is decompressed out.
-            for data in idat:
-                # :todo: add a max_length argument here to limit output
-                # size.
-                yield array('B', d.decompress(data))
-            yield array('B', d.flush())
-
-        self.preamble(lenient=lenient)
-        raw = iterdecomp(iteridat())
+        self.preamble(lenient=lenient)
+        raw = self.iterdecomp(self.iteridat(lenient=lenient))
 
         if self.interlace:
-            raw = array('B', itertools.chain(*raw))
-            arraycode = 'BH'[self.bitdepth>8]
-            # Like :meth:`group` but producing an array.array object for
-            # each row.
-            pixels = map(lambda *row: array(arraycode, row),
-                       *[iter(self.deinterlace(raw))]*self.width*self.planes)
+            pixels = self.iterinterlaced(array('B', b''.join(raw)))
         else:
             pixels = self.iterboxed(self.iterstraight(raw))
+        return self.width, self.height, pixels, self.metadata()
+
+    def iterinterlaced(self, raw):
+        """Iterator that deinterlaces `raw`, all of the decompressed
+        data of an interlaced image (which must be writable), and
+        yields each row in boxed row flat pixel format.
+        """
+
+        arraycode = 'BH'[self.bitdepth>8]
+        if _filter_backend == 'numpy':
+            a = self.deinterlace_array(raw).reshape(self.height, -1)
+            return (array(arraycode, row.tobytes()) for row in a)
+        # Like :meth:`group` but producing an array.array object
+        # for each row.
+        return map(lambda *row: array(arraycode, row),
+                   *[iter(self.deinterlace(raw))]*self.width*self.planes)
+
+    def iteridat(self, lenient=False):
+        """Iterator that yields all the ``IDAT`` chunks as strings.
+        Assumes that the :meth:`preamble` has been read.
+        """
+
+        while True:
+            try:
+                type, data = self._chunk(lenient=lenient)
+            except ValueError as e:
+                raise ChunkError(e.args[0])
+            if type == b'IEND':
+                # http://www.w3.org/TR/PNG/#11IEND
+                break
+            if type != b'IDAT':
+                continue
+            # type == b'IDAT'
+            # http://www.w3.org/TR/PNG/#11IDAT
+            if self.colormap and not self.plte:
+                warnings.warn("PLTE chunk is required before IDAT chunk")
+            yield data
+            # Let go of the slice, so that the mapping (if there is
+            # one) can be closed when ``IEND`` is read.
+            del data
+
+    def iterdecomp(self, idat, skip_rows=0):
+        """Iterator that yields decompressed strings.  `idat` should
+        be an iterator that yields the ``IDAT`` chunk data.  Each
+        string is at most `buffer_rows` scanlines long (see
+        :meth:`__init__`).
+        When `skip_rows` is not 0, `idat` should start at the sync
+        point for that row (see :meth:`read_rows`) instead of at the
+        start of the ``zlib`` stream.
+        """
+
+        inflate = self.inflater(skip_rows)
+        for data in idat:
+            for some in inflate(data):
+                yield some
+            # As in :meth:`iteridat`.
+            del data
+        for some in inflate(None):
+            yield some
+
+    def inflater(self, skip_rows=0):
+        """Return a generator function that decompresses the image
+        data an ``IDAT`` chunk at a time, for :meth:`iterdecomp`.
+        Called with the data of each chunk in turn, it yields the
+        decompressed strings; called with ``None`` after the last
+        chunk, it yields what remains.  `skip_rows` is as for
+        :meth:`iterdecomp`.
+        """
+
+        # Limit on the size of each piece of output, so that a small,
+        # highly compressed, chunk cannot inflate into a huge string.
+        max_length = max(1, self.buffer_rows) * (self.row_bytes + 1)
+        # Stop once the image is complete, even if the data is larger
+        # than the image it describes.  Other decoders ignore the
+        # extra data, so it is only warned about; it is never
+        # decompressed.
+        remaining = [self.decompressed_size()]
+        surplus = [False]
+        if skip_rows:
+            remaining[0] -= skip_rows * (self.row_bytes + 1)
+            # A sync point is in the middle of the stream: there is no
+            # zlib header, just raw deflate data.
+            d = zlib.decompressobj(-zlib.MAX_WBITS)
+        else:
+            d = zlib.decompressobj()
+
+        def trim(some):
+            if len(some) > remaining[0]:
+                warnings.warn("Too much image data in IDAT chunks;"
+                              " the extra data is ignored.")
+                surplus[0] = True
+                some = some[:remaining[0]]
+            remaining[0] -= len(some)
+            return some
+
+        def inflate(data):
+            if surplus[0]:
+                return
+            if data is None:
+                start = _start()
+                some = trim(d.flush())
+                _record('inflate', start, len(some))
+                yield some
+                return
+            # The chunk is passed to the decompressor, a piece at a
+            # time.
+            while True:
+                start = _start()
+                # When the image is complete ask for just 1 byte: the
+                # rest of a valid stream (its end of block code and
+                # checksum) inflates to nothing.
+                some = d.decompress(data,
+                                    min(max_length, remaining[0]) or 1)
+                _record('inflate', start, len(some))
+                data = d.unconsumed_tail
+                some = trim(some)
+                if surplus[0]:
+                    if some:
+                        yield some
+                    return
+                if some:
+                    yield some
+                # When the output is cut short there may be more of it
+                # to come, even if all of the input has been consumed.
+                if not data and len(some) < max_length:
+                    break
+        return inflate
+
+    def chunkheaders(self):
+        """Iterator that yields a (*type*, *offset*, *length*) triple
+        for each chunk from the current position to the end of the
+        file, where *offset* is the position in the file of the chunk's
+        data.  Only the chunk headers are read; the data is skipped
+        using ``seek``, so the input must be seekable.  The data and
+        checksums are not checked.
+        """
+
+        self.validate_signature()
+
+        while True:
+            if not self.atchunk:
+                self.atchunk = self.chunklentype()
+                if self.atchunk is None:
+                    return
+            length, type = self.atchunk
+            self.atchunk = None
+            offset = self.file.tell()
+            yield type, offset, length
+            if type == b'IEND':
+                return
+            self.file.seek(offset + length + 4)
+
+    def iteridat_from(self, idats, offset):
+        """Iterator that yields the ``IDAT`` data from `offset` (an
+        offset into the concatenated data of all the ``IDAT`` chunks)
+        onwards.  `idats` is a list of the (*offset*, *length*) of each
+        ``IDAT`` chunk's data in the file.
+        """
+
+        for position, length in idats:
+            if offset >= length:
+                offset -= length
+                continue
+            self.file.seek(position + offset)
+            data = self.file.read(length - offset)
+            if len(data) != length - offset:
+                raise ChunkError('IDAT chunk too short for required'
+                                 ' %i octets.' % length)
+            offset = 0
+            yield data
+
+    def read_rows(self, start, stop, lenient=False):
+        """
+        Read and decode only the rows from `start` to `stop` (as for
+        a slice: row `stop` is not included).  Returns (*width*,
+        *rows*, *pixels*, *metadata*), where *rows* is the number of
+        rows; otherwise the result is as for :meth:`read`.
+        When the file has a ``syNC`` chunk (see the `sync_rows`
+        argument of :class:`Writer`), decoding starts at the last sync
+        point at or above `start`, so that the cost does not depend on
+        how far down the image the rows are.  Otherwise decoding starts
+        at the top, but still stops after row `stop`.  The input must
+        be seekable.  The checksums of the ``IDAT`` chunks are not
+        checked.  The file (see :meth:`close`) is closed when the rows
+        have all been read, or the iterator is discarded.
+        """
+
+        def closing(pixels):
+            try:
+                for row in pixels:
+                    yield row
+            finally:
+                # The ``IEND`` chunk is not read, so close here, after
+                # letting go of the decoder (which may hold slices of
+                # a memory mapping).
+                pixels = None
+                self.close()
+
+        self.preamble(lenient=lenient)
+        start, stop, _ = slice(start, stop).indices(self.height)
+        stop = max(start, stop)
+        if self.interlace:
+            # Every pass covers the whole image; there is no short cut.
+            width, height, pixels, meta = self.read(lenient=lenient)
+            pixels = itertools.islice(pixels, start, stop)
+            return width, stop - start, closing(pixels), meta
+
+        idats = []
+        sync = None
+        for type, offset, length in self.chunkheaders():
+            if type == b'IDAT':
+                idats.append((offset, length))
+            elif type == b'syNC':
+                sync = offset, length
+        syncs = [(0, 0)]
+        if sync:
+            self.file.seek(sync[0])
+            data = self.file.read(sync[1])
+            if len(data) % 8:
+                raise FormatError('syNC chunk has incorrect length.')
+            syncs.extend(struct.unpack('!2I', data[i:i+8])
+                         for i in range(0, len(data), 8))
+        row, offset = max(p for p in syncs if p[0] <= start)
+
+        raw = self.iterdecomp(self.iteridat_from(idats, offset), row)
+        pixels = itertools.islice(self.iterstraight(raw),
+                                  start - row, stop - row)
+        return (self.width, stop - start, closing(self.iterboxed(pixels)),
+                self.metadata())
+
+    def decompressed_size(self):
+        """Return the size, in bytes, of the decompressed image data,
+        including the filter type byte of each scanline.  The
+        :meth:`preamble` should have been read.
+        """
+
+        if not self.interlace:
+            return self.height * (self.row_bytes + 1)
+        return sum(rows * (row_size + 1)
+                   for _, rows, _, row_size in self._pass_sizes())
+
+    def _pass_sizes(self, max_pass=7):
+        """Return a list describing each of the first `max_pass`
+        passes (reduced images) of an interlaced image that has any
+        pixels: its (*xstart*, *ystart*, *xstep*, *ystep*) as in
+        ``_adam7``, and its number of rows, pixels per row, and bytes
+        per row (without the filter type byte).
+        """
+
+        passes = []
+        for xstart, ystart, xstep, ystep in _adam7[:max_pass]:
+            if xstart >= self.width:
+                continue
+            rows = len(range(ystart, self.height, ystep))
+            if not rows:
+                continue
+            ppr = int(math.ceil((self.width-xstart)/float(xstep)))
+            row_size = int(math.ceil(self.psize * ppr))
+            passes.append(((xstart, ystart, xstep, ystep),
+                           rows, ppr, row_size))
+        return passes
+
+    def metadata(self):
+        """Return the metadata dictionary, as returned by :meth:`read`,
+        for the source image.  The :meth:`preamble` should have
+        been read.
+        """
+
         meta = dict()
         for attr in 'greyscale alpha planes bitdepth interlace'.split():
             meta[attr] = getattr(self, attr)
@@ -1850,7 +3268,7 @@ class Reader:
                 meta[attr] = a
         if self.plte:
             meta['palette'] = self.palette()
-        return self.width, self.height, pixels, meta
+        return meta
 
 
     def read_flat(self):
@@ -1868,6 +3286,279 @@ class Reader:
         pixel = array(arraycode, itertools.chain(*pixel))
         return x, y, pixel, meta
 
+    def direct_metadata(self):
+        """Return the metadata dictionary that :meth:`asDirect` returns,
+        which describes the direct representation of the image.  The
+        :meth:`preamble` should have been read.
+        """
+
+        meta = self.metadata()
+        if self.colormap:
+            meta['colormap'] = False
+            meta['alpha'] = bool(self.trns)
+            meta['bitdepth'] = 8
+            meta['planes'] = 3 + bool(self.trns)
+        elif self.trns:
+            meta['alpha'] = True
+            meta['planes'] += 1
+        if self.sbit:
+            sbit = struct.unpack('%dB' % len(self.sbit), self.sbit)
+            targetbitdepth = max(sbit)
+            if targetbitdepth > meta['bitdepth']:
+                raise Error('sBIT chunk %r exceeds bitdepth %d' %
+                    (sbit,self.bitdepth))
+            if min(sbit) <= 0:
+                raise Error('sBIT chunk %r has a 0-entry' % sbit)
+            meta['bitdepth'] = targetbitdepth
+        return meta
+
+    def iterarrays(self, lenient=False):
+        """Iterator that decodes the image data and yields it in
+        blocks of rows, each block a NumPy array with shape
+        (*rows*, *width*, *planes*) holding the (integer) sample
+        values of the source image.  Requires NumPy.
+        Straightlaced images are decoded incrementally, a block for
+        each piece of decompressed data; interlaced images are yielded
+        as a single block.
+        """
+
+        self.preamble(lenient=lenient)
+        raw = self.iterdecomp(self.iteridat(lenient=lenient))
+        shape = (self.width, self.planes)
+
+        if self.interlace:
+            raw = array('B', b''.join(raw))
+            if _filter_backend == 'numpy':
+                yield self.deinterlace_array(raw)
+                return
+            a = self.deinterlace(raw)
+            yield numpy.frombuffer(a, dtype=a.typecode).reshape((-1,) + shape)
+            return
+
+        if _filter_backend == 'numpy':
+            blocks = self.iterstraight_blocks(raw)
+        else:
+            blocks = (_npbytes(row).reshape(1, -1)
+                      for row in self.iterstraight(raw))
+        for block in blocks:
+            yield self.unpack_block(block).reshape((-1,) + shape)
+
+    def unpack_block(self, block, width=None):
+        """Convert a block of scanlines, a 2-dimensional uint8 NumPy
+        array with one (unfiltered) scanline per row, into a
+        2-dimensional array of sample values.  `width` is the width
+        of the scanlines in pixels, if they are not full width (as in
+        the reduced images of an interlaced image).
+        """
+
+        if width is None:
+            width = self.width
+        if self.bitdepth == 8:
+            return block
+        start = _start()
+        if self.bitdepth == 16:
+            # Samples are big-endian; ``astype`` swaps them to native.
+            out = block.view('>u2').astype(numpy.uint16)
+        else:
+            if self.bitdepth == 1:
+                out = numpy.unpackbits(block, axis=1)
+            else:
+                unpack_table(self.bitdepth)
+                table = _unpack_tables[self.bitdepth, 'numpy']
+                out = table[block].reshape(len(block), -1)
+            out = out[:, :width * self.planes]
+        _record('unpack', start, block.nbytes)
+        return out
+
+    def direct_block(self, samples):
+        """Convert a block of samples, as yielded by
+        :meth:`iterarrays`, to the direct representation that
+        :meth:`asDirect` uses, returning a NumPy array with shape
+        (*rows*, *width*, *planes*) where *planes* is as per
+        :meth:`direct_metadata`.
+        """
+
+        start = _start()
+        nbytes = samples.nbytes
+        if self.colormap:
+            plte = numpy.array(self.palette(), dtype=numpy.uint8)
+            samples = plte.take(samples[..., 0], axis=0)
+        elif self.trns:
+            maxval = 2**self.bitdepth - 1
+            opaque = (samples != numpy.array(self.transparent,
+                                             dtype=samples.dtype))
+            alpha = opaque.any(axis=-1, keepdims=True) * maxval
+            samples = numpy.concatenate(
+              [samples, alpha.astype(samples.dtype)], axis=-1)
+        if self.sbit:
+            sbit = struct.unpack('%dB' % len(self.sbit), self.sbit)
+            bitdepth = (self.bitdepth, 8)[self.colormap]
+            shift = bitdepth - max(sbit)
+            if shift > 0:
+                samples = samples >> shift
+        _record('convert', start, nbytes)
+        return samples
+
+    def read_into(self, out, lenient=False, transfer=None):
+        """Read the PNG file and decode it directly into the NumPy
+        array `out`, which should have shape (*height*, *width*,
+        *planes*) in the direct representation (see :meth:`asDirect`
+        and :meth:`direct_metadata`).  Returns (*width*, *height*,
+        *out*, *metadata*), the *metadata* being as for
+        :meth:`asDirect`.
+        When `out` has an integer datatype the sample values are
+        stored unchanged; when `out` has a floating point datatype they
+        are scaled to be between 0.0 and 1.0 (as :meth:`asFloat`
+        does), and then passed through the function `transfer`, if
+        given (see :func:`float_table`).  The image data is decoded a
+        block of rows at a time, without creating a Python object for
+        each row or sample.
+        When the decoded image cache is in use (see :func:`use_cache`)
+        and the image is in it, the image data is not read at all.
+        """
+
+        self.preamble(lenient=lenient)
+        meta = self.direct_metadata()
+        shape = (self.height, self.width, meta['planes'])
+        if out.shape != shape:
+            raise ValueError("out has shape %r, expected %r" %
+                             (out.shape, shape))
+        table = None
+        if out.dtype.kind == 'f':
+            table = numpy.array(
+              float_table(meta['bitdepth'], transfer=transfer),
+              dtype=out.dtype)
+        elif transfer is not None:
+            raise ValueError("transfer requires out to have a floating"
+                             " point datatype")
+        key = None
+        if _cache is not None:
+            key = self.cache_key()
+        if key is None:
+            self.decode_into(out, table, lenient)
+            return self.width, self.height, out, meta
+        pixels = _cache.get(key)
+        if pixels is None:
+            dtype = (numpy.uint8, numpy.uint16)[meta['bitdepth'] > 8]
+            pixels = numpy.empty(shape, dtype)
+            self.decode_into(pixels, None, lenient)
+            _cache.put(key, pixels)
+        else:
+            # The rest of the file is not needed.
+            self.close()
+        if table is None:
+            out[...] = pixels
+        else:
+            start = _start()
+            out[...] = table.take(pixels)
+            _record('convert', start, pixels.nbytes)
+        return self.width, self.height, out, meta
+
+    def decode_into(self, out, table=None, lenient=False):
+        """Decode the image data into `out`, for :meth:`read_into`,
+        which see.  Each sample is looked up in `table` (a NumPy
+        array), if given.
+        """
+
+        y = 0
+        for samples in self.iterarrays(lenient=lenient):
+            target = out[y:y + len(samples)]
+            samples = self.direct_block(samples)
+            if table is None:
+                target[...] = samples
+            else:
+                start = _start()
+                target[...] = table.take(samples)
+                _record('convert', start, samples.nbytes)
+            y += len(samples)
+        if y != self.height:
+            raise FormatError('Image data has %d rows, expected %d.' %
+                              (y, self.height))
+
+    def cache_key(self):
+        """Return the key for this image in the decoded image cache
+        (see :func:`use_cache`): for a file opened by name, its path,
+        size, and modification time; for `bytes`, a hash of them.
+        Returns ``None`` for a file object, which cannot be
+        identified.
+        """
+
+        if self.source is None or self.source[0] == 'file':
+            return self.source
+        buf = self.source[1]
+        return ('bytes', hashlib.blake2b(buf, digest_size=20).digest(),
+                len(buf))
+
+    def asarray(self, dtype=None, lenient=False, transfer=None):
+        """Read the PNG file and decode it into a new NumPy array
+        with shape (*height*, *width*, *planes*) and datatype `dtype`
+        (by default, ``uint8`` or ``uint16`` according to the bit
+        depth).  Returns (*width*, *height*, *pixels*, *metadata*) as
+        for :meth:`read_into`, which see; `transfer` is also as for
+        that method.
+        """
+
+        self.preamble(lenient=lenient)
+        meta = self.direct_metadata()
+        if dtype is None:
+            dtype = (numpy.uint8, numpy.uint16)[meta['bitdepth'] > 8]
+        out = numpy.empty((self.height, self.width, meta['planes']),
+                          dtype=dtype)
+        return self.read_into(out, lenient=lenient, transfer=transfer)
+
+    def read_preview(self, max_pass=1, upsample=False, lenient=False):
+        """Decode a low resolution preview of the image from the first
+        `max_pass` (1 to 7) passes of an interlaced image.  Only the
+        image data for those passes is read and decompressed.  Returns
+        (*width*, *height*, *pixels*, *metadata*), where *pixels* is a
+        NumPy array with shape (*height*, *width*, *planes*) in the
+        direct representation (as for :meth:`asarray`), and
+        *metadata* describes the full image.
+        The preview is the reduced image made of the pixels that the
+        passes provide: every 8th pixel across and down after pass 1,
+        every 4th across after pass 2, and so on; *width* and *height*
+        are its size.  If `upsample` is true, it is enlarged to the
+        size of the full image by repeating each pixel (nearest
+        neighbour).
+        Straightlaced images are decoded in full, a block of rows at a
+        time, and reduced in the same way.  Requires NumPy.
+        """
+
+        if not 1 <= max_pass <= 7:
+            raise ValueError("max_pass should be from 1 to 7")
+        self.preamble(lenient=lenient)
+        meta = self.direct_metadata()
+        xgrid, ygrid = _adam7_grid[max_pass - 1]
+        if self.interlace:
+            # Size of the decompressed data for the passes.
+            size = sum(rows * (row_size + 1) for _, rows, _, row_size
+                       in self._pass_sizes(max_pass))
+            raw = bytearray()
+            for some in self.iterdecomp(self.iteridat(lenient=lenient)):
+                raw.extend(some)
+                if len(raw) >= size:
+                    break
+            # The rest of the image, and so the ``IEND`` chunk, is not
+            # read.
+            self.close()
+            pixels = self.direct_block(
+              self.deinterlace_array(raw, max_pass, reduced=True))
+        else:
+            # Only the rows and columns of the preview are kept, and
+            # converted, from each block.
+            blocks = []
+            y = 0
+            for samples in self.iterarrays(lenient=lenient):
+                blocks.append(self.direct_block(
+                  samples[-y % ygrid::ygrid, ::xgrid]))
+                y += len(samples)
+            pixels = numpy.concatenate(blocks)
+        if upsample:
+            pixels = pixels.repeat(ygrid, axis=0).repeat(xgrid, axis=1)
+            pixels = pixels[:self.height, :self.width]
+        height, width = pixels.shape[:2]
+        return width, height, pixels, meta
+
     def palette(self, alpha='natural'):
         """Returns a palette that is a sequence of 3-tuples or 4-tuples,
         synthesizing it from the ``PLTE`` and ``tRNS`` chunks.  These
@@ -1920,6 +3611,8 @@ class Reader:
         *pixels* is the pixel data in boxed row flat pixel format (just
         like the :meth:`read` method).
         All the other aspects of the image data are not changed.
+        When NumPy is available the conversion is done a block of rows
+        at a time, using :meth:`direct_block`.
         """
 
         self.preamble()
@@ -1928,6 +3621,20 @@ class Reader:
         if not self.colormap and not self.trns and not self.sbit:
             return self.read()
 
+        if numpy is not None:
+            meta = self.direct_metadata()
+            if self.colormap:
+                # Check for the PLTE chunk now, not when the first
+                # row is converted.
+                self.palette()
+            def iterdirect():
+                for samples in self.iterarrays():
+                    samples = self.direct_block(samples)
+                    typecode = 'BH'[samples.dtype.itemsize > 1]
+                    for row in samples.reshape(len(samples), -1):
+                        yield array(typecode, row.tobytes())
+            return self.width, self.height, iterdirect(), meta
+
         x,y,pixels,meta = self.read()
 
         if self.colormap:
@@ -1935,20 +3642,16 @@ class Reader:
             meta['alpha'] = bool(self.trns)
             meta['bitdepth'] = 8
             meta['planes'] = 3 + bool(self.trns)
-            plte = self.palette()
+            # Lookup table from index to the bytes of the colour.
+            lut = [bytes(bytearray(colour)) for colour in self.palette()]
             def iterpal(pixels):
                 for row in pixels:
-                    row = [plte[x] for x in row]
-                    yield array('B', itertools.chain(*row))
+                    start = _start()
+                    out = array('B', b''.join(map(lut.__getitem__, row)))
+                    _record('convert', start, _nbytes(row))
+                    yield out
             pixels = iterpal(pixels)
         elif self.trns:
-            # It would be nice if there was some reasonable way
-            # of doing this without generating a whole load of
-            # intermediate tuples.  But tuples does seem like the
-            # easiest way, with no other way clearly much simpler or
-            # much faster.  (Actually, the L to LA conversion could
-            # perhaps go faster (all those 1-tuples!), but I still
-            # wonder whether the code proliferation is worth it)
             it = self.transparent
             maxval = 2**meta['bitdepth']-1
             planes = meta['planes']
@@ -1957,17 +3660,19 @@ class Reader:
             typecode = 'BH'[meta['bitdepth']>8]
             def itertrns(pixels):
                 for row in pixels:
-                    # For each row we group it into pixels, then form a
-                    # characterisation vector that says whether each
-                    # pixel is opaque or not.  Then we convert
-                    # True/False to 0/maxval (by multiplication),
-                    # and add it as the extra channel.
-                    row = group(row, planes)
-                    opa = map(it.__ne__, row)
-                    opa = map(maxval.__mul__, opa)
-                    opa = list(zip(opa)) # convert to 1-tuples
-                    yield array(typecode,
-                      itertools.chain(*map(operator.add, row, opa)))
+                    start = _start()
+                    # For each row we form the alpha channel, 0 where
+                    # the pixel is the transparent colour and maxval
+                    # elsewhere, and interleave it with the colour
+                    # channels.
+                    if planes == 1:
+                        opa = [maxval*(v != it[0]) for v in row]
+                    else:
+                        opa = [maxval*(v != it) for v in group(row, planes)]
+                    out = interleave_planes(array(typecode, row),
+                      array(typecode, opa), planes, 1)
+                    _record('convert', start, _nbytes(row))
+                    yield out
             pixels = itertrns(pixels)
         targetbitdepth = None
         if self.sbit:
@@ -1985,24 +3690,51 @@ class Reader:
             meta['bitdepth'] = targetbitdepth
             def itershift(pixels):
                 for row in pixels:
-                    yield [p >> shift for p in row]
+                    start = _start()
+                    out = [p >> shift for p in row]
+                    _record('convert', start, _nbytes(row))
+                    yield out
             pixels = itershift(pixels)
         return x,y,pixels,meta
 
-    def asFloat(self, maxval=1.0):
+    def asFloat(self, maxval=1.0, dtype=None, transfer=None):
         """Return image pixels as per :meth:`asDirect` method, but scale
         all pixel values to be floating point values between 0.0 and
-        *maxval*.
+        *maxval*.  If `transfer` is given, it is applied to each of
+        the scaled values (see :func:`float_table`).
+        Each row is a list of floats, unless `dtype` (a NumPy
+        floating point datatype, such as ``numpy.float32``) is given,
+        in which case each row is a NumPy array of that datatype,
+        converted from the samples a block of rows at a time.
         """
 
-        x,y,pixels,info = self.asDirect()
-        sourcemaxval = 2**info['bitdepth']-1
+        if dtype is not None:
+            if numpy is None:
+                raise Error("asFloat with a dtype requires NumPy")
+            self.preamble()
+            info = self.direct_metadata()
+        else:
+            x,y,pixels,info = self.asDirect()
+        table = float_table(info['bitdepth'], maxval, transfer)
         del info['bitdepth']
         info['maxval'] = float(maxval)
-        factor = float(maxval)/float(sourcemaxval)
+        if dtype is not None:
+            table = numpy.array(table, dtype=dtype)
+            def iterarray():
+                for samples in self.iterarrays():
+                    samples = self.direct_block(samples)
+                    start = _start()
+                    block = table.take(samples)
+                    _record('convert', start, samples.nbytes)
+                    for row in block.reshape(len(block), -1):
+                        yield row
+            return self.width, self.height, iterarray(), info
         def iterfloat():
             for row in pixels:
-                yield [factor * p for p in row]
+                start = _start()
+                out = list(map(table.__getitem__, row))
+                _record('convert', start, _nbytes(row))
+                yield out
         return x,y,iterfloat(),info
 
     def _as_rescale(self, get, targetbitdepth):
@@ -2093,6 +3825,7 @@ class Reader:
             return width,height,pixels,meta
         typecode = 'BH'[meta['bitdepth'] > 8]
         maxval = 2**meta['bitdepth'] - 1
+        filters = cpngfilters or pngfilters
         maxbuffer = struct.pack('=' + typecode, maxval) * 4 * width
         def newarray():
             return array(typecode, maxbuffer)
@@ -2105,14 +3838,14 @@ class Reader:
                     # into first three target channels, and A channel
                     # into fourth channel.
                     a = newarray()
-                    pngfilters.convert_la_to_rgba(row, a)
+                    filters.convert_la_to_rgba(row, a)
                     yield a
         elif meta['greyscale']:
             # L to RGBA
             def convert():
                 for row in pixels:
                     a = newarray()
-                    pngfilters.convert_l_to_rgba(row, a)
+                    filters.convert_l_to_rgba(row, a)
                     yield a
         else:
             assert not meta['alpha'] and not meta['greyscale']
@@ -2120,12 +3853,58 @@ class Reader:
             def convert():
                 for row in pixels:
                     a = newarray()
-                    pngfilters.convert_rgb_to_rgba(row, a)
+                    filters.convert_rgb_to_rgba(row, a)
                     yield a
         meta['alpha'] = True
         meta['greyscale'] = False
         return width,height,convert(),meta
 
+def probe(source):
+    """Return a dictionary of the metadata of a PNG file, read from
+    its chunk headers and its small header chunks only.  `source` is
+    a filename, or anything else that the :class:`Reader` constructor
+    accepts; a file must be seekable.  The dictionary has the keys:
+    ``width``, ``height``, ``bitdepth``, ``color_type``, ``interlace``;
+    ``gamma`` if there is a ``gAMA`` chunk;
+    ``x_pixels_per_unit``, ``y_pixels_per_unit``, ``unit_is_meter``
+    if there is a ``pHYs`` chunk (as for the :class:`Writer`
+    arguments of the same names); and
+    ``chunks``, a list of (*type*, *offset*, *length*) for each chunk
+    in the file, as yielded by :meth:`Reader.chunkheaders`.
+    The data of all the other chunks (``IDAT`` in particular) is
+    skipped using ``seek``, so the time taken does not depend on the
+    size of the image.  Checksums are not checked.
+    """
+
+    r = Reader(source)
+    try:
+        info = {}
+        chunks = []
+        for type, offset, length in r.chunkheaders():
+            chunks.append((type, offset, length))
+            if len(chunks) == 1 and type != b'IHDR':
+                raise FormatError(
+                  'First chunk should be IHDR, not %r.' % type)
+            if type not in (b'IHDR', b'gAMA', b'pHYs'):
+                continue
+            r.file.seek(offset)
+            data = r.file.read(length)
+            if len(data) != length:
+                raise ChunkError('Chunk %s too short for required %i'
+                                 ' octets.' % (type, length))
+            getattr(r, '_process_' + as_str(type))(data)
+        if not chunks:
+            raise FormatError('This PNG file has no chunks.')
+        for attr in ('width height bitdepth color_type interlace gamma'
+                     ' x_pixels_per_unit y_pixels_per_unit'
+                     ' unit_is_meter').split():
+            if hasattr(r, attr):
+                info[attr] = getattr(r, attr)
+        info['chunks'] = chunks
+        return info
+    finally:
+        r.close()
+
 def check_bitdepth_colortype(bitdepth, colortype):
     """Check that `bitdepth` and `colortype` are both valid,
     and specified in a valid combination. Returns if valid,
@@ -2160,97 +3939,1515 @@ def isinteger(x):
 
 # === Support for users without Cython ===
 
-try:
-    pngfilters
-except NameError:
-    class pngfilters(object):
-        def undo_filter_sub(filter_unit, scanline, previous, result):
-            """Undo sub filter."""
+# The pure-Python filtering functions are the reference that the other
+# filter backends are checked against (see :func:`check_filter_backends`).
+class pngfilters(object):
+    def undo_filter_sub(filter_unit, scanline, previous, result):
+        """Undo sub filter."""
+
+        ai = 0
+        # Loops starts at index fu.  Observe that the initial part
+        # of the result is already filled in correctly with
+        # scanline.
+        for i in range(filter_unit, len(result)):
+            x = scanline[i]
+            a = result[ai]
+            result[i] = (x + a) & 0xff
+            ai += 1
+    undo_filter_sub = staticmethod(undo_filter_sub)
 
-            ai = 0
-            # Loops starts at index fu.  Observe that the initial part
-            # of the result is already filled in correctly with
-            # scanline.
-            for i in range(filter_unit, len(result)):
-                x = scanline[i]
+    def undo_filter_up(filter_unit, scanline, previous, result):
+        """Undo up filter."""
+
+        for i in range(len(result)):
+            x = scanline[i]
+            b = previous[i]
+            result[i] = (x + b) & 0xff
+    undo_filter_up = staticmethod(undo_filter_up)
+
+    def undo_filter_average(filter_unit, scanline, previous, result):
+        """Undo up filter."""
+
+        ai = -filter_unit
+        for i in range(len(result)):
+            x = scanline[i]
+            if ai < 0:
+                a = 0
+            else:
                 a = result[ai]
-                result[i] = (x + a) & 0xff
+            b = previous[i]
+            result[i] = (x + ((a + b) >> 1)) & 0xff
+            ai += 1
+    undo_filter_average = staticmethod(undo_filter_average)
+
+    def undo_filter_paeth(filter_unit, scanline, previous, result):
+        """Undo Paeth filter."""
+
+        # Also used for ci.
+        ai = -filter_unit
+        for i in range(len(result)):
+            x = scanline[i]
+            if ai < 0:
+                a = c = 0
+            else:
+                a = result[ai]
+                c = previous[ai]
+            b = previous[i]
+            p = a + b - c
+            pa = abs(p - a)
+            pb = abs(p - b)
+            pc = abs(p - c)
+            if pa <= pb and pa <= pc:
+                pr = a
+            elif pb <= pc:
+                pr = b
+            else:
+                pr = c
+            result[i] = (x + pr) & 0xff
+            ai += 1
+    undo_filter_paeth = staticmethod(undo_filter_paeth)
+
+    def convert_la_to_rgba(row, result):
+        for i in range(3):
+            result[i::4] = row[0::2]
+        result[3::4] = row[1::2]
+    convert_la_to_rgba = staticmethod(convert_la_to_rgba)
+
+    def convert_l_to_rgba(row, result):
+        """Convert a grayscale image to RGBA. This method assumes
+        the alpha channel in result is already correctly
+        initialized.
+        """
+        for i in range(3):
+            result[i::4] = row
+    convert_l_to_rgba = staticmethod(convert_l_to_rgba)
+
+    def convert_rgb_to_rgba(row, result):
+        """Convert an RGB image to RGBA. This method assumes the
+        alpha channel in result is already correctly initialized.
+        """
+        for i in range(3):
+            result[i::4] = row[i::3]
+    convert_rgb_to_rgba = staticmethod(convert_rgb_to_rgba)
+
+    def filter_scanline(type, line, fo, prev=None):
+        """Filter a scanline, as :func:`filter_scanline` does.  This
+        is the pure-Python reference that the filter backends are
+        checked against.
+        """
+
+        # The output array.  Which, pathetically, we extend one-byte
+        # at a time (fortunately this is linear).
+        out = array('B', [type])
+
+        def sub():
+            ai = -fo
+            for x in line:
+                if ai >= 0:
+                    x = (x - line[ai]) & 0xff
+                out.append(x)
+                ai += 1
+        def up():
+            for i,x in enumerate(line):
+                x = (x - prev[i]) & 0xff
+                out.append(x)
+        def average():
+            ai = -fo
+            for i,x in enumerate(line):
+                if ai >= 0:
+                    x = (x - ((line[ai] + prev[i]) >> 1)) & 0xff
+                else:
+                    x = (x - (prev[i] >> 1)) & 0xff
+                out.append(x)
+                ai += 1
+        def paeth():
+            # http://www.w3.org/TR/PNG/#9Filter-type-4-Paeth
+            ai = -fo # also used for ci
+            for i,x in enumerate(line):
+                a = 0
+                b = prev[i]
+                c = 0
+
+                if ai >= 0:
+                    a = line[ai]
+                    c = prev[ai]
+                p = a + b - c
+                pa = abs(p - a)
+                pb = abs(p - b)
+                pc = abs(p - c)
+                if pa <= pb and pa <= pc:
+                    Pr = a
+                elif pb <= pc:
+                    Pr = b
+                else:
+                    Pr = c
+
+                x = (x - Pr) & 0xff
+                out.append(x)
                 ai += 1
+
+        if not prev:
+            # We're on the first line.  Some of the filters can be
+            # reduced to simpler cases which makes handling the line
+            # "off the top" of the image simpler.  "up" becomes
+            # "none"; "paeth" becomes "left" (non-trivial, but true).
+            # "average" needs to be handled specially.
+            if type == 2: # "up"
+                type = 0
+            elif type == 3:
+                prev = [0]*len(line)
+            elif type == 4: # "paeth"
+                type = 1
+        if type == 0:
+            out.extend(line)
+        elif type == 1:
+            sub()
+        elif type == 2:
+            up()
+        elif type == 3:
+            average()
+        else: # type == 4
+            paeth()
+        return out
+    filter_scanline = staticmethod(filter_scanline)
+
+    def filter_scanline_adaptive(line, fo, prev=None,
+                                 types=(0, 1, 2, 3, 4)):
+        """Filter a scanline, as :func:`filter_scanline_adaptive`
+        does, using :meth:`filter_scanline`.
+        """
+
+        best = None
+        for type in types:
+            out = pngfilters.filter_scanline(type, line, fo, prev)
+            cost = sum(min(x, 256 - x) for x in out[1:])
+            if best is None or cost < best[0]:
+                best = cost, out
+        return best[1]
+    filter_scanline_adaptive = staticmethod(filter_scanline_adaptive)
+
+
+# === NumPy filtering engine ===
+
+# Fewest "average" and "Paeth" scanlines in a block, times bytes per
+# pixel, for which :meth:`npfilters.undo_filter_rows` undoes the block
+# a diagonal at a time; with fewer it is faster to undo them one
+# scanline at a time.
+_diagonal_min = 256
+# Fewest scanlines per pass of the diagonals (see
+# :meth:`npfilters.undo_filter_rows`).
+_diagonal_rows = 256
+
+if numpy is not None:
+    def _npbytes(x):
+        """View `x` (an ``array``, ``bytearray``, or NumPy array) as a
+        1-dimensional NumPy array of bytes, without copying.
+        """
+
+        if isinstance(x, numpy.ndarray):
+            return x
+        return numpy.frombuffer(x, dtype=numpy.uint8)
+
+    class npfilters(object):
+        """Unfiltering functions that use NumPy.  The per-scanline
+        functions have the same signature as the ones in `class
+        pngfilters`; :meth:`undo_filter_rows` unfilters a whole block
+        of scanlines at once.
+        """
+
+        def undo_filter_sub(filter_unit, scanline, previous, result):
+            """Undo sub filter."""
+
+            # Each byte is the sum (modulo 256) of all the bytes at the
+            # same position in the preceding pixels, so a prefix sum
+            # over pixels undoes the filter.  Summing in uint8 wraps.
+            r = _npbytes(result)
+            s = _npbytes(scanline).reshape(-1, filter_unit)
+            numpy.cumsum(s, axis=0, dtype=numpy.uint8,
+                         out=r.reshape(-1, filter_unit))
         undo_filter_sub = staticmethod(undo_filter_sub)
 
         def undo_filter_up(filter_unit, scanline, previous, result):
             """Undo up filter."""
 
-            for i in range(len(result)):
-                x = scanline[i]
-                b = previous[i]
-                result[i] = (x + b) & 0xff
+            numpy.add(_npbytes(scanline), _npbytes(previous),
+                      out=_npbytes(result))
         undo_filter_up = staticmethod(undo_filter_up)
 
         def undo_filter_average(filter_unit, scanline, previous, result):
-            """Undo up filter."""
+            """Undo average filter."""
 
-            ai = -filter_unit
-            for i in range(len(result)):
-                x = scanline[i]
-                if ai < 0:
-                    a = 0
-                else:
-                    a = result[ai]
-                b = previous[i]
-                result[i] = (x + ((a + b) >> 1)) & 0xff
-                ai += 1
+            # Each byte depends on the reconstructed byte one pixel to
+            # its left, so this cannot be vectorized along the row.
+            # Looping over native ints is far quicker than looping
+            # over either ``array`` or NumPy elements.
+            r = _npbytes(result)
+            x = _npbytes(scanline).tolist()
+            b = _npbytes(previous).tolist()
+            fu = filter_unit
+            for i in range(fu):
+                x[i] = (x[i] + (b[i] >> 1)) & 0xff
+            for i in range(fu, len(x)):
+                x[i] = (x[i] + ((x[i-fu] + b[i]) >> 1)) & 0xff
+            r[:] = x
         undo_filter_average = staticmethod(undo_filter_average)
 
         def undo_filter_paeth(filter_unit, scanline, previous, result):
             """Undo Paeth filter."""
 
-            # Also used for ci.
-            ai = -filter_unit
-            for i in range(len(result)):
-                x = scanline[i]
-                if ai < 0:
-                    a = c = 0
-                else:
-                    a = result[ai]
-                    c = previous[ai]
-                b = previous[i]
-                p = a + b - c
-                pa = abs(p - a)
-                pb = abs(p - b)
-                pc = abs(p - c)
-                if pa <= pb and pa <= pc:
+            # The terms that only involve the previous row (`b`, `c`,
+            # and the distance ``pa = |b - c|``) are computed for the
+            # whole row up front; only the comparisons that involve the
+            # reconstructed byte `a` are left for the loop.
+            r = _npbytes(result)
+            fu = filter_unit
+            prev = _npbytes(previous).astype(numpy.int16)
+            c = numpy.zeros_like(prev)
+            c[fu:] = prev[:-fu]
+            pa = numpy.abs(prev - c).tolist()
+            x = _npbytes(scanline).tolist()
+            b = prev.tolist()
+            c = c.tolist()
+            for i in range(fu):
+                x[i] = (x[i] + b[i]) & 0xff
+            for i in range(fu, len(x)):
+                a = x[i-fu]
+                bi = b[i]
+                ci = c[i]
+                pai = pa[i]
+                pb = abs(a - ci)
+                pc = abs(a + bi - ci - ci)
+                if pai <= pb and pai <= pc:
                     pr = a
                 elif pb <= pc:
-                    pr = b
+                    pr = bi
                 else:
-                    pr = c
-                result[i] = (x + pr) & 0xff
-                ai += 1
+                    pr = ci
+                x[i] = (x[i] + pr) & 0xff
+            r[:] = x
         undo_filter_paeth = staticmethod(undo_filter_paeth)
 
-        def convert_la_to_rgba(row, result):
-            for i in range(3):
-                result[i::4] = row[0::2]
-            result[3::4] = row[1::2]
-        convert_la_to_rgba = staticmethod(convert_la_to_rgba)
+        def undo_filter_diagonals(filter_unit, rows, previous, types):
+            """Undo the filters for `rows`, a 2-dimensional array of
+            consecutive scanlines (without their filter type bytes),
+            in place.  `types` gives the filter type of each scanline,
+            and `previous` is the reconstructed scanline that precedes
+            `rows`, or ``None``.
+
+            The average and Paeth filters make each byte depend on the
+            reconstructed byte to its left, so a single scanline cannot
+            be vectorised.  Instead the rows are skewed so that pixel
+            `i` of row `k` lands in column ``k + i``; every pixel in
+            one column then depends only on earlier columns, and the
+            scanlines are reconstructed one column (an anti-diagonal
+            of the image) at a time, across all of the rows at once.
+            """
 
-        def convert_l_to_rgba(row, result):
-            """Convert a grayscale image to RGBA. This method assumes
-            the alpha channel in result is already correctly
-            initialized.
+            from numpy.lib.stride_tricks import as_strided
+
+            R, n = rows.shape
+            fu = filter_unit
+            W = n // fu
+            # Row 0 holds `previous`; row ``k`` holds scanline ``k-1``
+            # shifted right by ``k`` pixels.  Column 0 is the zero
+            # pixel to the left of every scanline.
+            q = numpy.zeros((R + 1, W + R + 1, fu), numpy.int16)
+            f = numpy.zeros((R + 1, W + R + 1, fu), numpy.uint8)
+
+            def skew(a):
+                s0, s1, s2 = a.strides
+                return as_strided(a[:, 1:], shape=(R + 1, W, fu),
+                                  strides=(s0 + s1, s1, s2))
+            if previous is not None:
+                skew(q)[0] = numpy.asarray(previous).reshape(W, fu)
+            # "Sub" scanlines do not depend on the previous scanline,
+            # so they are undone up front and then left as they are.
+            types = numpy.array(types).reshape(R, 1)
+            sub = types[:, 0] == 1
+            if sub.any():
+                s = rows[sub].reshape(-1, W, fu)
+                rows[sub] = numpy.cumsum(s, axis=1,
+                                         dtype=numpy.uint8).reshape(-1, n)
+                types[sub] = 0
+            skew(f)[1:] = rows.reshape(R, W, fu)
+            present = set(types.ravel().tolist())
+            # Per filter type, which rows use it (``None`` for all).
+            masks = {}
+            for t in present:
+                masks[t] = None if len(present) == 1 else types == t
+            for d in range(1, R + W):
+                k0 = max(1, d - W + 1)
+                k1 = min(R, d) + 1
+                a = q[k0:k1, d]
+                b = q[k0-1:k1-1, d]
+                pr = 0
+                for t in sorted(present):
+                    if t == 0:
+                        continue
+                    if t == 2:
+                        p = b
+                    elif t == 3:
+                        p = (a + b) >> 1
+                    else:
+                        c = q[k0-1:k1-1, d - 1]
+                        pa = numpy.abs(b - c)
+                        pb = numpy.abs(a - c)
+                        pc = numpy.abs(a + b - c - c)
+                        p = numpy.where((pa <= pb) & (pa <= pc), a,
+                                        numpy.where(pb <= pc, b, c))
+                    m = masks[t]
+                    pr = p if m is None else numpy.where(m[k0-1:k1-1], p, pr)
+                q[k0:k1, d + 1] = (f[k0:k1, d + 1] + pr) & 0xff
+            rows[...] = skew(q)[1:].reshape(R, n)
+            return rows
+        undo_filter_diagonals = staticmethod(undo_filter_diagonals)
+
+        def undo_filter_rows(filter_unit, block, previous=None):
+            """Undo the filters for a block of consecutive scanlines.
+            `block` is a writable 2-dimensional uint8 NumPy array with
+            one scanline per row, each row starting with its filter
+            type byte.  `previous` is the reconstructed scanline that
+            precedes the block, or ``None`` if the block starts the
+            image (or reduced pass).  The scanlines are unfiltered in
+            place and returned as a view of `block` with the filter
+            type column removed.
+            Runs of consecutive "up" scanlines are undone with a single
+            prefix sum down the columns of the block, and runs of "sub"
+            scanlines with a single prefix sum along the rows.  When
+            the block has enough "average" and "Paeth" scanlines it is
+            instead undone one anti-diagonal at a time (see
+            `undo_filter_diagonals`); otherwise those scanlines are
+            undone one at a time.
             """
-            for i in range(3):
-                result[i::4] = row
-        convert_l_to_rgba = staticmethod(convert_l_to_rgba)
 
-        def convert_rgb_to_rgba(row, result):
-            """Convert an RGB image to RGBA. This method assumes the
-            alpha channel in result is already correctly initialized.
+            types = block[:, 0]
+            if len(types) and types.max() > 4:
+                raise FormatError('Invalid PNG Filter Type.'
+                  '  See http://www.w3.org/TR/2003/REC-PNG-20031110/#9Filters .')
+            out = block[:, 1:]
+            if out.shape[1] == 0:
+                return out
+            fu = filter_unit
+            if (types > 2).sum() * fu >= _diagonal_min:
+                # Each pass takes one step per row and per pixel, so
+                # passes are made at least as tall as the scanlines
+                # are wide; the skewed copies then stay within a few
+                # times the size of the block.
+                step = max(_diagonal_rows, out.shape[1] // fu)
+                for i in range(0, len(types), step):
+                    part = out[i:i + step]
+                    npfilters.undo_filter_diagonals(
+                      fu, part, previous, types[i:i + step])
+                    previous = part[-1]
+                return out
+            # Indexes at which a run of same-type scanlines starts.
+            starts = [0] + (numpy.flatnonzero(numpy.diff(types)) + 1).tolist()
+            ends = starts[1:] + [len(types)]
+            for start, end in zip(starts, ends):
+                filter_type = types[start]
+                if start:
+                    previous = out[start-1]
+                run = out[start:end]
+                if filter_type == 1:
+                    # Setting the shape (rather than calling reshape)
+                    # guarantees a view, never a copy.
+                    s = run.view()
+                    s.shape = (end - start, -1, fu)
+                    numpy.cumsum(s, axis=1, dtype=numpy.uint8, out=s)
+                elif filter_type == 2:
+                    numpy.cumsum(run, axis=0, dtype=numpy.uint8, out=run)
+                    if previous is not None:
+                        run += previous
+                elif filter_type in (3, 4):
+                    undo = (npfilters.undo_filter_average,
+                            npfilters.undo_filter_paeth)[filter_type - 3]
+                    if previous is None:
+                        previous = numpy.zeros(out.shape[1], numpy.uint8)
+                    for row in run:
+                        undo(fu, row, previous, row)
+                        previous = row
+            return out
+        undo_filter_rows = staticmethod(undo_filter_rows)
+
+        def filter_candidates(filter_unit, line, previous=None):
+            """Filter the scanline `line` with every filter type.
+            Returns a uint8 array with 5 rows: row *n* is `line`
+            filtered with filter type *n*.  `previous` is the previous
+            (unfiltered) scanline, or ``None`` for the first scanline
+            of an image or pass.
             """
-            for i in range(3):
-                result[i::4] = row[i::3]
-        convert_rgb_to_rgba = staticmethod(convert_rgb_to_rgba)
+
+            # Unlike unfiltering, all the inputs are known in advance,
+            # so every filter can be computed for the whole row at once.
+            fu = filter_unit
+            x = _npbytes(line).astype(numpy.int16)
+            a = numpy.zeros_like(x)
+            a[fu:] = x[:-fu]
+            b = numpy.zeros_like(x)
+            c = numpy.zeros_like(x)
+            if previous is not None:
+                b[:] = _npbytes(previous)
+                c[fu:] = b[:-fu]
+            p = a + b - c
+            pa = numpy.abs(p - a)
+            pb = numpy.abs(p - b)
+            pc = numpy.abs(p - c)
+            pr = numpy.where((pa <= pb) & (pa <= pc), a,
+                             numpy.where(pb <= pc, b, c))
+            out = numpy.empty((5, len(x)), numpy.int16)
+            out[0] = x
+            out[1] = x - a
+            out[2] = x - b
+            out[3] = x - ((a + b) >> 1)
+            out[4] = x - pr
+            return (out & 0xff).astype(numpy.uint8)
+        filter_candidates = staticmethod(filter_candidates)
+
+        def filter_rows(filter_unit, block, filter_type, out=None):
+            """Filter a block of scanlines, a 2-dimensional uint8 array
+            with one (unfiltered) scanline per row, the first row being
+            the first scanline of the image.  `filter_type` is 0 to 4,
+            or ``'adaptive'`` to pick the filter for each scanline as
+            :func:`filter_scanline_adaptive` does.  Returns a uint8
+            array with one more column than `block`, each row being the
+            filter type byte followed by the filtered scanline; it is
+            `out`, if that is given.
+            """
+
+            fu = filter_unit
+            x = block.astype(numpy.int16)
+            a = numpy.zeros_like(x)
+            a[:, fu:] = x[:, :-fu]
+            b = numpy.zeros_like(x)
+            b[1:] = x[:-1]
+            c = numpy.zeros_like(x)
+            c[1:, fu:] = x[:-1, :-fu]
+            def candidate(type):
+                if type == 0:
+                    return x
+                if type == 1:
+                    return x - a
+                if type == 2:
+                    return x - b
+                if type == 3:
+                    return x - ((a + b) >> 1)
+                p = a + b - c
+                pa = numpy.abs(p - a)
+                pb = numpy.abs(p - b)
+                pc = numpy.abs(p - c)
+                return x - numpy.where((pa <= pb) & (pa <= pc), a,
+                                       numpy.where(pb <= pc, b, c))
+            if out is None:
+                out = numpy.empty((len(x), x.shape[1] + 1), numpy.uint8)
+            if filter_type == 'adaptive':
+                filtered = numpy.stack([candidate(type) & 0xff
+                                        for type in range(5)])
+                cost = numpy.minimum(filtered, 256 - filtered).sum(
+                  axis=2, dtype=numpy.int64)
+                types = cost.argmin(axis=0)
+                out[:, 0] = types
+                out[:, 1:] = filtered[types, numpy.arange(len(x))]
+            else:
+                out[:, 0] = filter_type
+                out[:, 1:] = candidate(filter_type) & 0xff
+            return out
+        filter_rows = staticmethod(filter_rows)
+
+
+# === Filter backends ===
+
+# Registered filter backends, by name, in order of preference.  A
+# backend is any object that has the ``undo_filter_sub``,
+# ``undo_filter_up``, ``undo_filter_average``, and ``undo_filter_paeth``
+# functions of `class pngfilters`.  A backend that can also filter
+# scanlines, for writing, has the ``filter_candidates`` and
+# ``filter_rows`` functions of `class npfilters`.
+_filter_backends = {}
+# Name of the backend used by :meth:`Reader.undo_filter`, and by
+# :func:`filter_scanline` and :class:`Encoder`.
+_filter_backend = None
+# Measured throughput (MB/s), by backend name.  See
+# :func:`filter_backend_info`.
+_filter_speeds = {}
+
+def register_filter_backend(name, filters):
+    """Register `filters` as a filter backend called `name`, so that
+    it can be selected with :func:`use_filter_backend`.
+    """
+
+    for f in ('sub', 'up', 'average', 'paeth'):
+        if not hasattr(filters, 'undo_filter_' + f):
+            raise Error("filter backend %s has no undo_filter_%s" %
+                        (name, f))
+    if (hasattr(filters, 'filter_candidates') !=
+        hasattr(filters, 'filter_rows')):
+        raise Error("filter backend %s should have both or neither of"
+                    " filter_candidates and filter_rows" % name)
+    _filter_backends[name] = filters
+    _filter_speeds.pop(name, None)
+
+def filter_backend():
+    """Return the name of the active filter backend: one of
+    ``'cpngfilters'``, ``'numpy'``, ``'python'`` (or the name of a
+    backend registered with :func:`register_filter_backend`).
+    """
+
+    return _filter_backend
+
+def _backend_function(name):
+    """Return the function `name` of the active filter backend, or
+    ``None`` if it does not have one (``filter_candidates`` and
+    ``filter_rows`` are optional).
+    """
+
+    return getattr(_filter_backends[_filter_backend], name, None)
+
+def use_filter_backend(name, check=False):
+    """Make the filter backend called `name` the one used for
+    unfiltering scanlines when reading, and for filtering them when
+    writing; a backend that cannot filter (such as ``'python'``)
+    leaves that to the pure-Python reference functions of `class
+    pngfilters`.  If `check` is true then the
+    backend is first checked against the pure-Python reference (see
+    :func:`check_filter_backends`).  Returns the name of the
+    previously active backend.
+    """
+
+    global _filter_backend
+
+    if name not in _filter_backends:
+        raise Error("unknown filter backend %r, expected one of: %s" %
+                    (name, ', '.join(_filter_backends)))
+    if check:
+        check_filter_backends([name])
+    previous = _filter_backend
+    _filter_backend = name
+    return previous
+
+def _undo_filter_block(filters, filter_unit, raw, row_bytes, split=0):
+    """Unfilter the scanlines in the bytes `raw` using the backend
+    `filters`.  Returns the reconstructed bytes (without the filter
+    type bytes).  A backend that unfilters blocks of scanlines is
+    given the first `split` scanlines, if that is not 0, and then the
+    rest (with the scanline before them) as a second block.
+    """
+
+    rb = row_bytes + 1
+    if hasattr(filters, 'undo_filter_rows'):
+        block = numpy.frombuffer(bytearray(raw), dtype=numpy.uint8)
+        block = block.reshape(-1, rb)
+        previous = None
+        out = []
+        for part in (block[:split], block[split:]):
+            if len(part):
+                part = filters.undo_filter_rows(filter_unit, part,
+                                                previous)
+                previous = part[-1]
+                out.append(part.tobytes())
+        return b''.join(out)
+    undo = (None,
+            filters.undo_filter_sub,
+            filters.undo_filter_up,
+            filters.undo_filter_average,
+            filters.undo_filter_paeth)
+    out = array('B')
+    previous = array('B', [0]*row_bytes)
+    for i in range(0, len(raw), rb):
+        result = array('B', raw[i+1:i+rb])
+        if raw[i]:
+            undo[raw[i]](filter_unit, result, previous, result)
+        out.extend(result)
+        previous = result
+    return tostring(out)
+
+def _filter_test_data(filter_unit, row_bytes, rows, seed=0,
+                      types=(0, 1, 2, 3, 4)):
+    """Make `rows` scanlines of pseudo-random filtered data, cycling
+    through the filter types `types`.
+    """
+
+    rnd = random.Random(seed)
+    raw = array('B')
+    for i in range(rows):
+        raw.append(types[i % len(types)])
+        raw.extend(rnd.getrandbits(8) for _ in range(row_bytes))
+    return tostring(raw)
+
+def _filter_block(filters, filter_unit, raw, row_bytes, filter_type):
+    """Filter the scanlines in the bytes `raw`, each `row_bytes` long,
+    with `filter_type` (as for :class:`Writer`) using the backend
+    `filters`, or the pure-Python reference if `filters` is
+    ``None``.  Returns the filtered bytes, with the filter type byte
+    of each scanline.
+    """
+
+    if filters is not None:
+        block = numpy.frombuffer(raw, dtype=numpy.uint8)
+        block = block.reshape(-1, row_bytes)
+        return filters.filter_rows(filter_unit, block,
+                                   filter_type).tobytes()
+    out = array('B')
+    previous = None
+    for i in range(0, len(raw), row_bytes):
+        line = array('B', raw[i:i+row_bytes])
+        if filter_type == 'adaptive':
+            out.extend(pngfilters.filter_scanline_adaptive(
+              line, filter_unit, previous))
+        else:
+            out.extend(pngfilters.filter_scanline(
+              filter_type, line, filter_unit, previous))
+        previous = line
+    return tostring(out)
+
+def check_filter_backends(names=None):
+    """Check that the filter backends called `names` (by default, all
+    of the registered backends) produce results that are bit-for-bit
+    the same as the pure-Python reference, for every filter type and
+    filter unit: both unfiltering and, for the backends that can,
+    filtering.  Raises :class:`Error` if any of them differ.
+    """
+
+    if names is None:
+        names = list(_filter_backends)
+    for fu in (1, 2, 3, 4, 6, 8):
+        raw = _filter_test_data(fu, fu * 17, 21, seed=fu)
+        expected = _undo_filter_block(pngfilters, fu, raw, fu * 17)
+        # The unfiltered scanlines are as good as any to filter.
+        lines = expected
+        for name in names:
+            filters = _filter_backends[name]
+            got = _undo_filter_block(filters, fu, raw, fu * 17)
+            if got != expected:
+                raise Error("filter backend %s does not match the"
+                            " reference (filter unit %d)" % (name, fu))
+        # Enough "average" and "Paeth" scanlines, in a tall enough
+        # block, for :meth:`npfilters.undo_filter_rows` to undo them a
+        # diagonal at a time, in more than one pass, after a previous
+        # block.
+        rows = 16 + 2 * _diagonal_rows
+        tall = _filter_test_data(fu, fu * 5, rows, seed=fu,
+                                 types=(1, 3, 4, 4, 3, 2))
+        tall_expected = _undo_filter_block(pngfilters, fu, tall, fu * 5)
+        for name in names:
+            got = _undo_filter_block(_filter_backends[name], fu, tall,
+                                     fu * 5, split=16)
+            if got != tall_expected:
+                raise Error("filter backend %s does not match the"
+                            " reference (filter unit %d, %d scanlines)"
+                            % (name, fu, rows))
+        for name in names:
+            filters = _filter_backends[name]
+            if not hasattr(filters, 'filter_rows'):
+                continue
+            for filter_type in (0, 1, 2, 3, 4, 'adaptive'):
+                if (_filter_block(filters, fu, lines, fu * 17,
+                                  filter_type) !=
+                    _filter_block(None, fu, lines, fu * 17,
+                                  filter_type)):
+                    raise Error("filter backend %s does not match the"
+                                " reference when filtering (filter"
+                                " type %s, filter unit %d)" %
+                                (name, filter_type, fu))
+            # The scanlines one at a time, with and without a previous
+            # scanline.
+            previous = None
+            for i in range(0, len(lines), fu * 17):
+                line = array('B', lines[i:i + fu * 17])
+                candidates = filters.filter_candidates(fu, line, previous)
+                for filter_type in range(5):
+                    if (candidates[filter_type].tobytes() !=
+                        tostring(pngfilters.filter_scanline(
+                          filter_type, line, fu, previous))[1:]):
+                        raise Error("filter backend %s does not match"
+                                    " the reference when filtering"
+                                    " a scanline (filter type %d,"
+                                    " filter unit %d)" %
+                                    (name, filter_type, fu))
+                previous = line
+
+def benchmark_filter_backend(name=None, nbytes=2**20):
+    """Measure the speed, in MB/s of unfiltered output, at which the
+    filter backend called `name` (by default, the active one)
+    unfilters about `nbytes` of RGB scanlines using an even mix of
+    filter types.
+    """
+
+    name = name or _filter_backend
+    filters = _filter_backends[name]
+    row_bytes = 3 * 1024
+    raw = _filter_test_data(3, row_bytes, max(1, nbytes // row_bytes))
+    t = time.time()
+    out = _undo_filter_block(filters, 3, raw, row_bytes)
+    elapsed = max(time.time() - t, 1e-9)
+    speed = len(out) / elapsed / 1e6
+    _filter_speeds[name] = speed
+    return speed
+
+def filter_backend_info():
+    """Return a dictionary describing the filter backends: ``name``
+    (the active backend), ``available`` (all registered backends), and
+    ``mb_per_s`` (the measured speed of the active backend; it is
+    measured, with :func:`benchmark_filter_backend`, the first time
+    it is needed).
+    """
+
+    if _filter_backend not in _filter_speeds:
+        benchmark_filter_backend()
+    return dict(name=_filter_backend,
+                available=list(_filter_backends),
+                mb_per_s=_filter_speeds[_filter_backend])
+
+if cpngfilters is not None:
+    register_filter_backend('cpngfilters', cpngfilters)
+if numpy is not None:
+    register_filter_backend('numpy', npfilters)
+register_filter_backend('python', pngfilters)
+
+# The first registered backend is the preferred one, but the
+# ``PNG_FILTER_BACKEND`` environment variable can name another.
+_filter_backend = list(_filter_backends)[0]
+if os.environ.get('PNG_FILTER_BACKEND'):
+    try:
+        use_filter_backend(os.environ['PNG_FILTER_BACKEND'])
+    except Error as e:
+        warnings.warn(str(e), RuntimeWarning)
+
+
+# === Decoded image cache ===
+
+class ImageCache:
+    """
+    Least recently used cache of decoded images (the NumPy arrays made
+    by :meth:`Reader.read_into`), holding at most `max_bytes` bytes of
+    them.  The arrays are stored read only, and are copied out of the
+    cache.  Counts of the ``hits``, ``misses``, and ``evictions`` are
+    kept.  Safe to use from several threads.  See :func:`use_cache`.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Return the image stored under `key`, or ``None``."""
+
+        with self.lock:
+            pixels = self.entries.get(key)
+            if pixels is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return pixels
+
+    def put(self, key, pixels):
+        """Store `pixels` under `key`, evicting the least recently
+        used images to make room.  Images larger than the whole cache
+        are not stored.
+        """
+
+        if pixels.nbytes > self.max_bytes:
+            return
+        pixels.flags.writeable = False
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            self.entries[key] = pixels
+            self.nbytes += pixels.nbytes
+            while self.nbytes > self.max_bytes:
+                key, old = self.entries.popitem(last=False)
+                self.nbytes -= old.nbytes
+                self.evictions += 1
+
+    def clear(self):
+        """Remove all the images (the counts are kept)."""
+
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def info(self):
+        """Return a dict of the counts, the number of ``entries``,
+        their size in ``bytes``, and ``max_bytes``.
+        """
+
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses,
+                        evictions=self.evictions,
+                        entries=len(self.entries), bytes=self.nbytes,
+                        max_bytes=self.max_bytes)
+
+# The process wide cache, or ``None`` when there is no cache.
+_cache = None
+
+def use_cache(max_bytes):
+    """Cache the images decoded by :meth:`Reader.read_into` (and so
+    by :meth:`Reader.asarray`), so that decoding the same image again
+    does not read, decompress, or unfilter its image data.  Images
+    read from a file named by `filename` are identified by the file's
+    path, size, and modification time; those read from `bytes`, by a
+    hash of them; those read from a file object are not cached.  Up
+    to `max_bytes` bytes of images are kept (the least recently used
+    are removed first); ``None`` or 0 stops caching and empties the
+    cache.  Returns the new :class:`ImageCache`, or ``None``.
+    The ``PNG_CACHE_BYTES`` environment variable, if set, is passed to
+    this function when the module is imported.
+    """
+
+    global _cache
+
+    if not max_bytes:
+        _cache = None
+    else:
+        _cache = ImageCache(int(max_bytes))
+    return _cache
+
+def cache_info():
+    """Return the counts and size of the decoded image cache, as for
+    :meth:`ImageCache.info`, or ``None`` if there is no cache.
+    """
+
+    if _cache is None:
+        return None
+    return _cache.info()
+
+if os.environ.get('PNG_CACHE_BYTES'):
+    try:
+        use_cache(int(os.environ['PNG_CACHE_BYTES']))
+    except ValueError as e:
+        warnings.warn(str(e), RuntimeWarning)
+
+
+# === Instrumentation ===
+
+# The functions that :func:`instrument` has installed.  Each is called
+# with (*stage*, *seconds*, *nbytes*) as each stage of decoding or
+# encoding completes a piece of work.  When the list is empty, which
+# is usual, the stages do not read the clock at all.
+_collectors = []
+
+_clock = time.perf_counter
+
+def _start():
+    """Return the time that a stage starts, or ``None`` when nothing
+    is being instrumented.  Pass it to :func:`_record` when the stage
+    ends.
+    """
+
+    if _collectors:
+        return _clock()
+    return None
+
+def _record(stage, start, nbytes=0):
+    """Report that `stage`, started at `start` (from :func:`_start`),
+    has finished handling `nbytes` bytes.
+    """
+
+    if start is None:
+        return
+    seconds = _clock() - start
+    for collector in list(_collectors):
+        collector(stage, seconds, nbytes)
+
+def _nbytes(row):
+    """Size of `row` in bytes, or its length when it is not a buffer
+    (such as a list of values).
+    """
+
+    if isbuffer(row):
+        return memoryview(row).nbytes
+    return len(row)
+
+class Stats:
+    """
+    Time, in seconds, and bytes handled for each stage of decoding and
+    encoding, as collected by :func:`instrument`.  The stages are:
+
+    ``chunk_read``, ``chunk_write``
+      reading and writing chunks (their data and checksums);
+    ``crc``
+      calculating chunk checksums;
+    ``inflate``, ``deflate``
+      decompressing and compressing the image data;
+    ``unfilter``, ``filter``
+      undoing and applying scanline filters;
+    ``unpack``
+      converting scanlines into sample values;
+    ``convert``
+      the conversions made by :meth:`Reader.asDirect` and
+      :meth:`Reader.asFloat` (palette lookup, transparency, ``sBIT``
+      shift, and scaling to floating point).
+
+    For ``inflate`` the bytes are those of the decompressed data; for
+    the other stages they are those of the stage's input.
+    """
+
+    def __init__(self):
+        self.stages = {}
+
+    def add(self, stage, seconds, nbytes=0):
+        """Add one piece of work to the totals for `stage`."""
+
+        totals = self.stages.setdefault(stage, [0, 0.0, 0])
+        totals[0] += 1
+        totals[1] += seconds
+        totals[2] += nbytes
+
+    def __getitem__(self, stage):
+        """Return a dict of the ``calls``, ``seconds``, and ``bytes``
+        recorded for `stage` (all zero if it has not been seen).
+        """
+
+        calls, seconds, nbytes = self.stages.get(stage, (0, 0.0, 0))
+        return dict(calls=calls, seconds=seconds, bytes=nbytes)
+
+    def as_dict(self):
+        """Return the totals of all stages seen, as a dict mapping
+        each stage to a dict as returned by :meth:`__getitem__`.
+        """
+
+        return dict((stage, self[stage]) for stage in self.stages)
+
+    def reset(self):
+        self.stages.clear()
+
+    def report(self):
+        """Return the totals as a table in a string, slowest stage
+        first.
+        """
+
+        lines = ['%-12s %8s %10s %12s' % ('stage', 'calls', 'seconds',
+                                          'bytes')]
+        for stage, (calls, seconds, nbytes) in sorted(
+          self.stages.items(), key=lambda item: -item[1][1]):
+            lines.append('%-12s %8d %10.6f %12d' %
+                         (stage, calls, seconds, nbytes))
+        return '\n'.join(lines)
+
+@contextlib.contextmanager
+def instrument(stats=None, hook=None):
+    """
+    Context manager that records the time taken by, and the bytes
+    handled by, each stage of every :class:`Reader` and :class:`Writer`
+    used inside the ``with`` statement (see :class:`Stats` for the
+    stages).  The totals are added to `stats`, a new :class:`Stats`
+    object if not given, which is the value of the ``with`` statement::
+
+        with png.instrument() as stats:
+            png.Reader(filename='in.png').asFloat()
+        print(stats.report())
+
+    `hook`, if given, is called with (*stage*, *seconds*, *nbytes*)
+    for each piece of work, so that the measurements can be forwarded
+    elsewhere as they are made.
+
+    Instrumentation is process wide: work done in other threads
+    whilst the ``with`` statement runs is also recorded (but not work
+    done in other processes, such as those of :func:`decode_many`).
+    """
+
+    if stats is None:
+        stats = Stats()
+    collectors = [stats.add]
+    if hook is not None:
+        collectors.append(hook)
+    _collectors.extend(collectors)
+    try:
+        yield stats
+    finally:
+        for collector in collectors:
+            _collectors.remove(collector)
+
+
+# === Batch decoding and encoding ===
+
+# The pixels are passed between processes in shared memory, which the
+# parent process creates and removes.  The worker processes only
+# attach to it.
+
+def _decode_shared(source, name, shape, dtype, lenient):
+    """Worker for :func:`decode_many`."""
+
+    from multiprocessing import shared_memory
+
+    shm = shared_memory.SharedMemory(name)
+    try:
+        out = numpy.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        Reader(source).read_into(out, lenient=lenient)
+        del out
+    finally:
+        shm.close()
+
+def _encode_shared(destination, name, shape, dtype, info):
+    """Worker for :func:`encode_many`."""
+
+    from multiprocessing import shared_memory
+
+    shm = shared_memory.SharedMemory(name)
+    try:
+        pixels = numpy.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        with open(destination, 'wb') as f:
+            with Writer(**info) as w:
+                w.write(f, pixels.reshape(shape[0], -1))
+        del pixels
+    finally:
+        shm.close()
+    return destination
+
+def _imap_shared(prepare, finish, items, workers, max_pending, max_bytes):
+    """Run jobs on a pool of `workers` processes, yielding their
+    results in the order that they complete.  For each of the `items`,
+    ``prepare(item)`` returns a (*shm*, *args*, *extra*) triple: a
+    ``SharedMemory`` object, the function and arguments to run in a
+    worker, and anything else; when the job has finished,
+    ``finish(shm, result, extra)`` returns the value to yield, and the
+    shared memory is removed.  New jobs are not started while
+    `max_pending` jobs, or `max_bytes` of shared memory, are in use.
+    """
+
+    import concurrent.futures
+    from multiprocessing import resource_tracker
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if max_pending is None:
+        max_pending = 2 * workers
+    if os.name == 'posix':
+        # Start the tracker of shared memory before the workers, so
+        # that they share it.
+        resource_tracker.ensure_running()
+    items = iter(items)
+    # Shared memory and extra, for each job not yet finished.
+    pending = {}
+    inflight = 0
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        try:
+            while True:
+                while (items is not None and len(pending) < max_pending and
+                       (max_bytes is None or inflight < max_bytes)):
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        items = None
+                        break
+                    shm, args, extra = prepare(item)
+                    try:
+                        future = pool.submit(*args)
+                    except:
+                        shm.close()
+                        shm.unlink()
+                        raise
+                    pending[future] = shm, extra
+                    inflight += shm.size
+                if not pending:
+                    return
+                done, _ = concurrent.futures.wait(
+                  pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    shm, extra = pending.pop(future)
+                    inflight -= shm.size
+                    try:
+                        result = finish(shm, future.result(), extra)
+                    finally:
+                        shm.close()
+                        shm.unlink()
+                    yield result
+        finally:
+            # Stopped early: wait for (or cancel) the remaining jobs,
+            # so that no worker is using the shared memory.
+            for future in pending:
+                future.cancel()
+            concurrent.futures.wait(pending)
+            for shm, extra in pending.values():
+                shm.close()
+                shm.unlink()
+
+def decode_many(sources, workers=None, max_pending=None, max_bytes=None,
+                dtype=None, lenient=False):
+    """Decode many PNG files on a pool of `workers` processes (by
+    default, one for each CPU).  `sources` is an iterable of
+    filenames (or ``bytes``).  Yields a (*source*, *pixels*,
+    *metadata*) triple for each one as it is decoded, not necessarily
+    in the order given; *pixels* and *metadata* are as returned by
+    :meth:`Reader.asarray` with the given `dtype`.
+    Each worker decodes directly into shared memory, which the parent
+    copies into *pixels*; the pixels are never pickled.  At most
+    `max_pending` images (by default, twice the number of workers)
+    are in progress at once, and no new one is started while
+    `max_bytes` (if given) of pixels are in progress.  Requires
+    NumPy.
+    """
+
+    from multiprocessing import shared_memory
+
+    def prepare(source):
+        # The header chunks give the size of the decoded image.
+        r = Reader(source)
+        try:
+            r.preamble(lenient=lenient)
+        finally:
+            r.close()
+        meta = r.direct_metadata()
+        shape = (r.height, r.width, meta['planes'])
+        t = dtype
+        if t is None:
+            t = (numpy.uint8, numpy.uint16)[meta['bitdepth'] > 8]
+        t = numpy.dtype(t)
+        size = int(numpy.prod(shape)) * t.itemsize
+        shm = shared_memory.SharedMemory(create=True, size=max(1, size))
+        args = (_decode_shared, source, shm.name, shape, t.str, lenient)
+        return shm, args, (source, shape, t, meta)
+
+    def finish(shm, result, extra):
+        source, shape, t, meta = extra
+        pixels = numpy.ndarray(shape, dtype=t, buffer=shm.buf).copy()
+        return source, pixels, meta
+
+    return _imap_shared(prepare, finish, sources, workers, max_pending,
+                        max_bytes)
+
+def encode_many(items, workers=None, max_pending=None, max_bytes=None):
+    """Write many PNG files on a pool of `workers` processes (by
+    default, one for each CPU).  `items` is an iterable of
+    (*destination*, *pixels*) or (*destination*, *pixels*, *info*)
+    tuples: *destination* is a filename; *pixels* is a NumPy array
+    with shape (*height*, *width*) or (*height*, *width*, *planes*);
+    and *info* is a dictionary of arguments for :class:`Writer`.
+    Unless *info* says otherwise, the image size and colour type are
+    taken from the shape of *pixels* (1 to 4 planes being L, LA, RGB,
+    and RGBA), and the bit depth is 16 for 2-byte samples, 8
+    otherwise.  Yields each *destination* as its file is written, not
+    necessarily in the order given.
+    The pixels are copied into shared memory for the workers, not
+    pickled; `max_pending` and `max_bytes` limit the work in progress
+    as for :func:`decode_many`.  Requires NumPy.
+    """
+
+    from multiprocessing import shared_memory
+
+    def prepare(item):
+        if len(item) == 2:
+            destination, pixels = item
+            info = {}
+        else:
+            destination, pixels, info = item
+        pixels = numpy.asarray(pixels)
+        if pixels.ndim == 2:
+            pixels = pixels[..., numpy.newaxis]
+        height, width, planes = pixels.shape
+        kw = dict(width=width, height=height, greyscale=planes < 3,
+                  alpha=planes in (2, 4),
+                  bitdepth=(8, 16)[pixels.dtype.itemsize == 2])
+        kw.update(info)
+        shm = shared_memory.SharedMemory(create=True,
+                                         size=max(1, pixels.nbytes))
+        view = numpy.ndarray(pixels.shape, dtype=pixels.dtype,
+                             buffer=shm.buf)
+        view[...] = pixels
+        del view
+        args = (_encode_shared, destination, shm.name, pixels.shape,
+                pixels.dtype.str, kw)
+        return shm, args, None
+
+    def finish(shm, result, extra):
+        return result
+
+    return _imap_shared(prepare, finish, items, workers, max_pending,
+                        max_bytes)
+
+
+# === asyncio support ===
+
+def _take(iterator, n):
+    """Return a list of (up to) the next `n` items of `iterator`."""
+
+    return list(itertools.islice(iterator, n))
+
+def _iter_async(iterable, loop):
+    """Iterate, in a thread other than the event loop's, over the
+    asynchronous iterable `iterable`, which is read on `loop` an item
+    at a time.
+    """
+
+    import asyncio
+
+    iterator = iterable.__aiter__()
+    async def anext():
+        return await iterator.__anext__()
+    while True:
+        try:
+            yield asyncio.run_coroutine_threadsafe(anext(), loop).result()
+        except StopAsyncIteration:
+            return
+
+class AsyncReader:
+    """
+    PNG decoder for ``asyncio``.  The file is read a chunk at a time
+    from an asynchronous stream, and the decompression and unfiltering
+    of the image data, which are the slow parts, are run in an
+    executor, so that the event loop is not held up.
+    """
+
+    def __init__(self, stream, executor=None, buffer_rows=8):
+        """
+        `stream` should be an ``asyncio.StreamReader``, or another
+        object with a coroutine method ``read(n)``; it should be
+        positioned at the start of the PNG file.  `executor` is the
+        ``concurrent.futures`` executor for the slow parts (by default,
+        the event loop's default executor).  `buffer_rows` is as for
+        :class:`Reader`; rows are also decoded, and yielded to the
+        event loop, in batches of this many.
+        """
+
+        self.stream = stream
+        self.executor = executor
+        self.buffer_rows = buffer_rows
+        # The :class:`Reader` that does the decoding, once the
+        # preamble has been read.
+        self.reader = None
+        # Length of the first ``IDAT`` chunk.
+        self.idat_length = None
+
+    async def readexactly(self, n):
+        """Read `n` bytes from the stream; fewer only at the end of
+        the stream.
+        """
+
+        import asyncio
+
+        if hasattr(self.stream, 'readexactly'):
+            try:
+                return await self.stream.readexactly(n)
+            except asyncio.IncompleteReadError as e:
+                return e.partial
+        data = b''
+        while len(data) < n:
+            some = await self.stream.read(n - len(data))
+            if not some:
+                break
+            data += some
+        return data
+
+    async def chunkheader(self):
+        """Read a chunk's length and type, returning them as for
+        :meth:`Reader.chunklentype`, together with the 8 bytes
+        read.
+        """
+
+        x = await self.readexactly(8)
+        if len(x) != 8:
+            raise FormatError(
+              'End of file whilst reading chunk length and type.')
+        length,type = struct.unpack('!I4s', x)
+        if length > 2**31-1:
+            raise FormatError('Chunk %s is too large: %d.' % (type,length))
+        return length, type, x
+
+    async def chunkdata(self, type, length):
+        """Read a chunk's data and checksum."""
+
+        data = await self.readexactly(length)
+        if len(data) != length:
+            raise ChunkError('Chunk %s too short for required %i octets.'
+              % (type, length))
+        checksum = await self.readexactly(4)
+        if len(checksum) != 4:
+            raise ChunkError('Chunk %s too short for checksum.' % type)
+        return data, checksum
+
+    async def preamble(self, lenient=False):
+        """Read the chunks that precede the first ``IDAT`` chunk and
+        process them, as :meth:`Reader.preamble` does.  They are small,
+        so are processed in the event loop.
+        """
+
+        if self.reader is not None:
+            return
+        head = [await self.readexactly(8)]
+        while True:
+            length, type, x = await self.chunkheader()
+            head.append(x)
+            if type == b'IDAT':
+                break
+            head.extend(await self.chunkdata(type, length))
+        reader = Reader(bytes=b''.join(head), buffer_rows=self.buffer_rows)
+        reader.preamble(lenient=lenient)
+        self.reader = reader
+        self.idat_length = length
+
+    async def read(self, lenient=False):
+        """Read the PNG file's preamble.  Returns (*width*, *height*,
+        *pixels*, *metadata*) as :meth:`Reader.read` does, except that
+        *pixels* is an asynchronous iterator of the rows, which reads
+        and decodes the rest of the file.
+        """
+
+        await self.preamble(lenient=lenient)
+        r = self.reader
+        return r.width, r.height, self.iterrows(lenient), r.metadata()
+
+    async def iterrows(self, lenient=False):
+        """Asynchronous iterator that reads the rest of the file, from
+        the first ``IDAT`` chunk, and yields each row in boxed row flat
+        pixel format.  Straightlaced images are decoded as each chunk
+        arrives; interlaced images when all the image data has
+        arrived.
+        """
+
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        r = self.reader
+        inflate = r.inflater()
+        if r.interlace:
+            raw = array('B')
+        else:
+            unfilter = r.unfilterer()
+
+        def decode(data, checksum):
+            r.verify_checksum(b'IDAT', data, checksum, lenient=lenient)
+            for some in inflate(data):
+                if r.interlace:
+                    raw.frombytes(some)
+                    continue
+                for row in r.iterboxed(unfilter(some)):
+                    yield row
+
+        def finish():
+            for some in inflate(None):
+                if r.interlace:
+                    raw.frombytes(some)
+                else:
+                    for row in r.iterboxed(unfilter(some)):
+                        yield row
+            if r.interlace:
+                for row in r.iterinterlaced(raw):
+                    yield row
+            else:
+                unfilter(None)
+
+        # As for :meth:`Reader.inflater`, at least one row at a time.
+        batch_rows = max(1, self.buffer_rows)
+        length, type = self.idat_length, b'IDAT'
+        while True:
+            data, checksum = await self.chunkdata(type, length)
+            rows = None
+            if type == b'IDAT':
+                # Checked in the executor, with the decoding.
+                rows = decode(data, checksum)
+            else:
+                r.verify_checksum(type, data, checksum, lenient=lenient)
+            if type == b'IEND':
+                # http://www.w3.org/TR/PNG/#11IEND
+                rows = finish()
+            if rows is not None:
+                while True:
+                    batch = await loop.run_in_executor(
+                      self.executor, _take, rows, batch_rows)
+                    for row in batch:
+                        yield row
+                    if not batch or len(batch) < batch_rows:
+                        break
+            if type == b'IEND':
+                return
+            length, type, x = await self.chunkheader()
+
+class AsyncWriter:
+    """
+    PNG encoder for ``asyncio``.  The filtering and compression are
+    run in an executor, and the output is written to an asynchronous
+    stream.
+    """
+
+    def __init__(self, *args, **kw):
+        """
+        The arguments are those of :class:`Writer`, together with the
+        keyword arguments `executor`, the ``concurrent.futures``
+        executor to run the encoder in (by default, the event loop's
+        default executor), and `max_pending`, the number of pieces of
+        output (of up to `chunk_limit` bytes each) that the encoder can
+        get ahead of the stream by (by default, 4).
+        """
+
+        self.executor = kw.pop('executor', None)
+        self.max_pending = max(1, kw.pop('max_pending', 4))
+        self.writer = Writer(*args, **kw)
+
+    def close(self):
+        """Shut down the pool of threads used when `workers` is more
+        than 1 (see :meth:`Writer.close`).
+        """
+
+        self.writer.close()
+
+    async def write(self, stream, rows):
+        """Write a PNG image to `stream`, an ``asyncio.StreamWriter``
+        or another object with a ``write`` method and a coroutine
+        method ``drain``.  `rows` are as for :meth:`Writer.write`;
+        they can also be an asynchronous iterable, which is read a row
+        at a time as the encoder needs them (except for an interlaced
+        image, which the encoder has to read in full).  The encoder
+        waits whilst the stream is being drained, so neither the
+        rows nor the output build up in memory.
+        """
+
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(self.max_pending)
+        # Set when the output is no longer wanted.
+        aborted = []
+
+        def put(data):
+            # Called in the executor; waits for room in the queue.
+            if aborted:
+                raise Error("AsyncWriter.write was abandoned")
+            asyncio.run_coroutine_threadsafe(queue.put(data),
+                                             loop).result()
+
+        class outfile:
+            # Passes the encoder's output from the executor to the
+            # event loop.
+            @staticmethod
+            def write(data):
+                put(bytes(data))
+
+        if hasattr(rows, '__aiter__'):
+            rows = _iter_async(rows, loop)
+
+        def encode():
+            try:
+                self.writer.write(outfile, rows)
+            finally:
+                if not aborted:
+                    # Marks the end of the output.
+                    put(None)
+
+        done = loop.run_in_executor(self.executor, encode)
+        try:
+            while True:
+                data = await queue.get()
+                if data is None:
+                    break
+                stream.write(data)
+                await stream.drain()
+        except BaseException:
+            aborted.append(True)
+            # Make room for any output that the encoder is waiting to
+            # queue, so that it can see `aborted` and stop.
+            while not queue.empty():
+                queue.get_nowait()
+            # The encoder's exception is not of interest now.
+            done.add_done_callback(
+              lambda future: future.cancelled() or future.exception())
+            raise
+        await done
 
 
 # === Command Line Support ===
@@ -2406,16 +5603,12 @@ def write_pnm(file, width, height, pixels, meta):
                   'TUPLTYPE %s\nENDHDR\n' %
                   (width, height, planes, maxval, tupltype))
     file.write(header.encode('ascii'))
-    # Values per row
-    vpr = planes * width
-    # struct format
-    fmt = '>%d' % vpr
     if maxval > 0xff:
-        fmt = fmt + 'H'
+        pack = pack16
     else:
-        fmt = fmt + 'B'
+        pack = bytearray
     for row in pixels:
-        file.write(struct.pack(fmt, *row))
+        file.write(pack(row))
     file.flush()
 
 def color_triple(color):